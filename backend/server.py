@@ -1,22 +1,62 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request, Response, File, UploadFile
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request, Response, File, UploadFile, Query
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.encoders import jsonable_encoder
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import time
+import socket
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, field_validator
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Type
 import uuid
+import json
+import hashlib
 import random
 import string
+import secrets
+import asyncio
+import re
+import heapq
+import unicodedata
 import httpx
 import base64
+import csv
+import io
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape as xml_escape
+from collections import Counter, defaultdict
+from cachetools import TTLCache
+import numpy as np
+from array import array
+from scipy import sparse
+from pymongo import IndexModel, ASCENDING, DESCENDING, ReplaceOne, UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
-def generate_short_id():
-    """Generate 8 character order ID (letters + numbers)"""
-    chars = string.ascii_uppercase + string.digits
-    return ''.join(random.choices(chars, k=8))
+ORDER_ID_EPOCH = 1735689600  # 2025-01-01T00:00:00Z
+ORDER_ID_ALPHABET = string.digits + string.ascii_uppercase  # base36 in ASCII order
+ORDER_ID_RANDOM_CHARS = 8
+
+def generate_order_id():
+    """Generate 14 character time-ordered order ID (letters + numbers).
+
+    6 base36 chars of seconds since ORDER_ID_EPOCH followed by 8 random chars,
+    so IDs sort by creation second and new orders land at the end of the id index.
+    The random part keeps same-second collisions negligible (36**8 per second).
+    """
+    seconds = max(0, int(time.time()) - ORDER_ID_EPOCH)
+    prefix = ''
+    for _ in range(6):
+        seconds, digit = divmod(seconds, 36)
+        prefix = ORDER_ID_ALPHABET[digit] + prefix
+    return prefix + ''.join(secrets.choice(ORDER_ID_ALPHABET) for _ in range(ORDER_ID_RANDOM_CHARS))
+
+def generate_tracking_number():
+    return f"ATB{generate_order_id()}"
 from datetime import datetime, timezone, timedelta
 from passlib.context import CryptContext
 import jwt
@@ -115,6 +155,11 @@ class Category(BaseModel):
     is_active: bool = True
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class CategoryWithStats(Category):
+    product_count: int = 0  # active products only
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+
 class Product(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -132,6 +177,10 @@ class Product(BaseModel):
     is_active: bool = True
     rating: float = 0.0
     review_count: int = 0
+    view_count: int = 0
+    favorite_count: int = 0
+    popularity: int = 0  # weighted views + favorites, maintained by ProductCounterBuffer
+    units_sold: int = 0  # paid, non-cancelled orders; revenue and windows stay admin-only (SALES RANKING)
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class Coupon(BaseModel):
@@ -148,7 +197,7 @@ class Coupon(BaseModel):
 
 class Order(BaseModel):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=generate_short_id)
+    id: str = Field(default_factory=generate_order_id)
     tracking_number: Optional[str] = None
     customer_name: str
     customer_email: str
@@ -212,6 +261,7 @@ class PaymentTransaction(BaseModel):
     amount: float
     currency: str = "eur"
     payment_status: str = "pending"  # pending, paid, failed, expired
+    payment_method: str = "stripe"
     order_id: Optional[str] = None
     cart_items: List[Dict[str, Any]] = []
     metadata: Optional[Dict[str, Any]] = None
@@ -224,6 +274,334 @@ class CreateCheckoutRequest(BaseModel):
     message: str
     session_id: str
 
+class BulkAdminRequest(BaseModel):
+    ids: List[str]
+    operation: str
+    value: Optional[str] = None  # new status / payment status / role
+    reason: Optional[str] = None  # required for order cancellation
+
+# ============= INDEXES =============
+
+# Declared index set, created on startup by ensure_indexes()
+INDEXES: Dict[str, List[IndexModel]] = {
+    "products": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        # Listing: equality filters, then the sort key, then price for the range filter,
+        # so a price-filtered listing walks the index in sort order instead of sorting in memory
+        IndexModel([("is_active", ASCENDING), ("created_at", DESCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("rating", DESCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("popularity", DESCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("category_id", ASCENDING), ("created_at", DESCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("category_id", ASCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("category_id", ASCENDING), ("rating", DESCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("category_id", ASCENDING), ("popularity", DESCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("brand", ASCENDING), ("created_at", DESCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("brand", ASCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("brand", ASCENDING), ("rating", DESCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("brand", ASCENDING), ("popularity", DESCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("units_sold", DESCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("units_sold_30d", DESCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("category_id", ASCENDING), ("units_sold", DESCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("category_id", ASCENDING), ("units_sold_30d", DESCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("brand", ASCENDING), ("units_sold", DESCENDING), ("price", ASCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("brand", ASCENDING), ("units_sold_30d", DESCENDING), ("price", ASCENDING)]),
+        # Admin best-seller rankings
+        IndexModel([("is_active", ASCENDING), ("units_sold_7d", DESCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("sales_revenue", DESCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("sales_revenue_7d", DESCENDING)]),
+        IndexModel([("is_active", ASCENDING), ("sales_revenue_30d", DESCENDING)]),
+    ],
+    "orders": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel(
+            [("tracking_number", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"tracking_number": {"$type": "string"}}
+        ),
+        # Admin listing: keyset on (created_at, id) with optional equality filter
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("payment_status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        # Customer order history (every checkout path stores customer_email)
+        IndexModel([("customer_email", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    # Same lookups as the hot collection, read on a miss
+    "orders_archive": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel(
+            [("tracking_number", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"tracking_number": {"$type": "string"}}
+        ),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("customer_email", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "payment_transactions": [
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("payment_status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("payment_method", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("user_email", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("session_id", ASCENDING)]),
+    ],
+    "idempotency_keys": [
+        IndexModel([("created_at", ASCENDING)], expireAfterSeconds=int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 86400))),
+    ],
+    "users": [
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("role", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("email_lower", ASCENDING)]),
+        IndexModel([("name_lower", ASCENDING)]),
+        IndexModel([("phone_digits", ASCENDING)]),
+        IndexModel([("referral_code", ASCENDING)]),
+    ],
+    "user_cards": [
+        IndexModel([("user_id", ASCENDING)]),
+    ],
+    "user_sessions": [
+        IndexModel([("user_id", ASCENDING), ("expires_at", ASCENDING)]),
+    ],
+    "product_sales_daily": [
+        IndexModel([("day", ASCENDING)]),
+    ],
+    "referrals": [
+        IndexModel([("referrer_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("referred_email", ASCENDING)], unique=True),
+    ],
+    "referral_stats": [
+        IndexModel([("signups", DESCENDING)]),
+        IndexModel([("converted", DESCENDING)]),
+        IndexModel([("revenue", DESCENDING)]),
+    ],
+    "product_related": [
+        IndexModel([("product_id", ASCENDING)], unique=True),
+    ],
+}
+
+async def ensure_indexes():
+    """Create all declared indexes (no-op for indexes that already exist)"""
+    for collection_name, indexes in INDEXES.items():
+        try:
+            await db[collection_name].create_indexes(indexes)
+        except Exception as e:
+            logging.error(f"Index creation failed for {collection_name}: {e}")
+
+# ============= PAGINATION =============
+
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 500
+COUNT_CACHE_TTL = int(os.environ.get('COUNT_CACHE_TTL', 60))
+
+_count_cache: TTLCache = TTLCache(maxsize=1024, ttl=COUNT_CACHE_TTL)
+
+def page_limit(limit: int) -> int:
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+CURSOR_VALUE_TYPES = (str, int, float, bool)
+
+def encode_cursor(*values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+def decode_cursor(cursor: str, size: int = 2) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        values = None
+    # Only scalars: a dict here would reach the query as an operator ({"$ne": ...})
+    if (
+        not isinstance(values, list) or len(values) != size
+        or not all(value is None or isinstance(value, CURSOR_VALUE_TYPES) for value in values)
+    ):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def apply_keyset(query: Dict[str, Any], cursor: Optional[str], sort_field: str = "created_at", id_field: str = "id") -> Dict[str, Any]:
+    """Restrict a (sort_field desc, id_field desc) query to rows after cursor"""
+    if not cursor:
+        return query
+    value, last_id = decode_cursor(cursor)
+    after = {"$or": [
+        {sort_field: {"$lt": value}},
+        {sort_field: value, id_field: {"$lt": last_id}}
+    ]}
+    if not query:
+        return after
+    return {"$and": [query, after]}
+
+def iso_bound(value: datetime) -> str:
+    """UTC ISO string comparable with stored created_at values (naive means UTC)"""
+    value = value.astimezone(timezone.utc) if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    return value.isoformat()
+
+def date_range_filter(date_from: Optional[datetime], date_to: Optional[datetime]) -> Optional[Dict[str, str]]:
+    if not date_from and not date_to:
+        return None
+    bounds = {}
+    if date_from:
+        bounds["$gte"] = iso_bound(date_from)
+    if date_to:
+        bounds["$lte"] = iso_bound(date_to)
+    return bounds
+
+async def cached_count(collection, query: Dict[str, Any]) -> int:
+    """Estimated count for the whole collection, short-lived cached count for filters"""
+    if not query:
+        return await collection.estimated_document_count()
+    key = (collection.name, json.dumps(query, sort_keys=True, default=str))
+    if key not in _count_cache:
+        _count_cache[key] = await collection.count_documents(query)
+    return _count_cache[key]
+
+def set_page_headers(response: Response, next_cursor: Optional[str], total: int):
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    response.headers["X-Total-Count"] = str(total)
+
+# ============= IDEMPOTENCY =============
+
+IDEMPOTENCY_WAIT_SECONDS = 30  # how long a duplicate waits for the first execution
+IDEMPOTENCY_LOCK_SECONDS = 120  # in-progress records not refreshed for this long are abandoned
+IDEMPOTENCY_HEARTBEAT_SECONDS = 30  # how often a running handler refreshes its claim
+IDEMPOTENCY_SAVE_ATTEMPTS = 3
+
+_idempotency_inflight: Dict[str, asyncio.Future] = {}
+
+async def run_idempotent(request: Request, scope: str, handler, response_model: Optional[Type[BaseModel]] = None):
+    """Execute handler once per Idempotency-Key header and replay its response.
+
+    The first request claims the key by inserting an in-progress record and
+    refreshes its heartbeat while the handler runs; the response is stored on
+    success and the record is removed if the handler fails so the client can
+    retry. Only a claim whose heartbeat stopped (the worker died mid-request)
+    is taken over. Once the handler has succeeded the claim is never removed:
+    if its response could not be stored, retries get 409 until the TTL index
+    drops the record. Duplicates wait for the first execution - on a local
+    future when it runs in this worker, otherwise by polling the record.
+    Pass the route's response_model so the stored body is filtered and
+    serialized exactly like the response the first caller received.
+    """
+    key = request.headers.get("Idempotency-Key")
+    if not key:
+        return await handler()
+    if len(key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key too long")
+    
+    record_id = f"{scope}:{key}"
+    fingerprint = hashlib.sha256(await request.body()).hexdigest()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + IDEMPOTENCY_WAIT_SECONDS
+    delay = 0.05
+    
+    while True:
+        now = datetime.now(timezone.utc)
+        try:
+            await db.idempotency_keys.insert_one({
+                "_id": record_id,
+                "state": "in_progress",
+                "fingerprint": fingerprint,
+                "created_at": now,
+                "heartbeat_at": now
+            })
+            break
+        except DuplicateKeyError:
+            pass
+        
+        inflight = _idempotency_inflight.get(record_id)
+        if inflight is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(inflight), max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                pass
+        
+        record = await db.idempotency_keys.find_one({"_id": record_id})
+        if record is None:
+            continue  # first execution failed, claim the key ourselves
+        if record.get('fingerprint') != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        if record.get('state') == "completed":
+            return JSONResponse(
+                content=record.get('response'),
+                status_code=record.get('status_code', 200),
+                headers={"Idempotent-Replayed": "true"}
+            )
+        if record.get('state') == "succeeded":
+            raise HTTPException(
+                status_code=409,
+                detail="A request with this Idempotency-Key already succeeded but its response is unavailable"
+            )
+        # Take over a key whose worker died mid-request (its heartbeat stopped)
+        stale = await db.idempotency_keys.delete_one({
+            "_id": record_id,
+            "state": "in_progress",
+            "heartbeat_at": {"$lt": datetime.now(timezone.utc) - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}
+        })
+        if stale.deleted_count:
+            continue
+        if loop.time() >= deadline:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 1.0)
+    
+    future = loop.create_future()
+    _idempotency_inflight[record_id] = future
+    heartbeat = asyncio.create_task(refresh_idempotency_claim(record_id))
+    try:
+        try:
+            result = await handler()
+        except Exception:
+            heartbeat.cancel()
+            await db.idempotency_keys.delete_one({"_id": record_id})
+            raise
+        heartbeat.cancel()
+        await save_idempotent_response(record_id, result, response_model)
+        return result
+    finally:
+        heartbeat.cancel()
+        _idempotency_inflight.pop(record_id, None)
+        future.set_result(None)
+
+async def refresh_idempotency_claim(record_id: str):
+    """Keep an in-progress claim fresh so slow handlers are not taken over"""
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_HEARTBEAT_SECONDS)
+        try:
+            await db.idempotency_keys.update_one(
+                {"_id": record_id, "state": "in_progress"},
+                {"$set": {"heartbeat_at": datetime.now(timezone.utc)}}
+            )
+        except Exception as e:
+            logging.warning(f"Could not refresh idempotency claim {record_id}: {e}")
+
+async def save_idempotent_response(record_id: str, result, response_model: Optional[Type[BaseModel]] = None):
+    """Store a completed response, retrying.
+
+    When the response itself cannot be stored the claim is at least marked
+    succeeded, which stops it from ever being taken over as abandoned.
+    """
+    marked = False
+    for attempt in range(IDEMPOTENCY_SAVE_ATTEMPTS):
+        try:
+            body = response_model.model_validate(result) if response_model else result
+            await db.idempotency_keys.update_one(
+                {"_id": record_id},
+                {"$set": {"state": "completed", "status_code": 200, "response": jsonable_encoder(body)}}
+            )
+            return
+        except Exception as e:
+            error = e
+        if not marked:
+            try:
+                await db.idempotency_keys.update_one({"_id": record_id}, {"$set": {"state": "succeeded"}})
+                marked = True
+            except Exception:
+                pass
+        if attempt < IDEMPOTENCY_SAVE_ATTEMPTS - 1:
+            await asyncio.sleep(0.1 * 2 ** attempt)
+    logging.error(f"Could not store idempotent response for {record_id}, claim left in place: {error}")
+
 # ============= AUTH HELPERS =============
 
 async def get_current_user_from_token(session_token: str) -> Optional[Dict]:
@@ -319,6 +697,7 @@ async def register(user_data: UserRegister, response: Response):
     )
     
     # Check if referral code is valid and add bonus
+    referrer = None
     if user_data.referral_code:
         logging.info(f"Looking for referrer with code: {user_data.referral_code}")
         referrer = await db.users.find_one({"referral_code": user_data.referral_code})
@@ -329,7 +708,7 @@ async def register(user_data: UserRegister, response: Response):
             logging.info(f"Updating referrer with id: {referrer_id}")
             result = await db.users.update_one(
                 {"$or": [{"id": referrer_id}, {"_id": referrer_id}]},
-                {"$inc": {"referral_bonus": 10.0}}
+                {"$inc": {"referral_bonus": REFERRAL_BONUS}}
             )
             logging.info(f"Update result: matched={result.matched_count}, modified={result.modified_count}")
         else:
@@ -338,7 +717,11 @@ async def register(user_data: UserRegister, response: Response):
     doc = user.model_dump(by_alias=True)
     if 'created_at' in doc:
         doc['created_at'] = doc['created_at'].isoformat()
+    doc.update(user_search_fields(doc))
     await db.users.insert_one(doc)
+    await record_user_signup()
+    if referrer:
+        await record_referral(referrer, doc)
     
     # Create session
     session_token = str(uuid.uuid4())
@@ -466,7 +849,9 @@ async def process_session_id(request: Request, response: Response):
             doc = new_user.model_dump(by_alias=True)
             if 'created_at' in doc:
                 doc['created_at'] = doc['created_at'].isoformat()
+            doc.update(user_search_fields(doc))
             await db.users.insert_one(doc)
+            await record_user_signup()
         
         # Use session_token from Emergent
         session_token = user_data["session_token"]
@@ -597,6 +982,7 @@ async def update_user_profile(profile_data: UserProfileUpdate, request: Request,
         update_data['postal_code'] = profile_data.postal_code
     
     if update_data:
+        update_data.update(user_search_fields(update_data))
         await db.users.update_one(
             {"$or": [{"id": user_id}, {"_id": user_id}]},
             {"$set": update_data}
@@ -688,8 +1074,15 @@ async def card_to_card_payment(request: Request, response: Response):
     """Process card-to-card payment (simulation) - transfers to merchant card"""
     user = await get_current_user(request, response)
     user_id = user.get("id") or user.get("_id")
-    
     body = await request.json()
+    return await run_idempotent(
+        request,
+        f"card-to-card:{user_id}",
+        lambda: process_card_to_card_payment(user, body)
+    )
+
+async def process_card_to_card_payment(user: Dict[str, Any], body: Dict[str, Any]):
+    user_id = user.get("id") or user.get("_id")
     card_id = body.get('card_id')
     amount = float(body.get('amount', 0))
     cart_items = body.get('cart_items', [])
@@ -736,9 +1129,9 @@ async def card_to_card_payment(request: Request, response: Response):
         )
     
     # Create order
-    order_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
     order_doc = {
-        "id": order_id,
+        "id": generate_order_id(),
+        "tracking_number": generate_tracking_number(),
         "user_id": user_id,
         "customer_name": user.get('name', 'N/A'),
         "customer_email": user.get('email', ''),
@@ -752,7 +1145,8 @@ async def card_to_card_payment(request: Request, response: Response):
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    await db.orders.insert_one(order_doc)
+    await insert_order(order_doc)
+    order_id = order_doc['id']
     
     # Create payment transaction
     transaction_doc = {
@@ -811,9 +1205,10 @@ async def get_user_orders(request: Request, response: Response):
     user_email = user['email']
     
     # Find orders by email
-    orders = await db.orders.find({"customer_email": user_email}, {"_id": 0}).sort("created_at", -1).to_list(100)
+    orders = await find_orders_newest_first({"customer_email": user_email}, {"_id": 0}, 100)
     
     for order in orders:
+        expand_order_timeline(order)
         if isinstance(order.get('created_at'), str):
             order['created_at'] = datetime.fromisoformat(order['created_at'])
         if isinstance(order.get('updated_at'), str):
@@ -821,6 +1216,38 @@ async def get_user_orders(request: Request, response: Response):
     
     return orders
 
+ORDER_SUMMARY_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "tracking_number": 1,
+    "status": 1,
+    "payment_status": 1,
+    "payment_method": 1,
+    "total": 1,
+    "created_at": 1,
+    "item_count": {"$size": {"$ifNull": ["$items", []]}}
+}
+
+@api_router.get("/user/orders/history")
+async def get_user_order_history(request: Request, response: Response, cursor: Optional[str] = None, limit: int = 20):
+    """Paginated order summaries for the current user, newest first"""
+    user = await get_current_user(request, response)
+    limit = page_limit(limit)
+    
+    query = {"customer_email": user['email']}
+    orders = await find_orders_newest_first(apply_keyset(query, cursor), ORDER_SUMMARY_PROJECTION, limit + 1)
+    next_cursor = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        next_cursor = encode_cursor(orders[-1].get('created_at'), orders[-1].get('id'))
+    total = await cached_count(db.orders, query) + await cached_count(db.orders_archive, query)
+    set_page_headers(response, next_cursor, total)
+    
+    for order in orders:
+        if isinstance(order.get('created_at'), str):
+            order['created_at'] = datetime.fromisoformat(order['created_at'])
+    return orders
+
 @api_router.get("/user/favorites")
 async def get_user_favorites(request: Request, response: Response):
     """Get user's favorite products"""
@@ -850,10 +1277,12 @@ async def add_to_favorites(product_id: str, request: Request, response: Response
         raise HTTPException(status_code=404, detail="Product not found")
     
     # Add to favorites (if not already there)
-    await db.users.update_one(
+    result = await db.users.update_one(
         {"$or": [{"id": user_id}, {"_id": user_id}]},
         {"$addToSet": {"favorites": product_id}}
     )
+    if result.modified_count:
+        product_counters.record(product_id, "favorite_count")
     
     return {"message": "Added to favorites"}
 
@@ -873,12 +1302,65 @@ async def remove_from_favorites(product_id: str, request: Request, response: Res
 
 # ============= CATEGORY ROUTES =============
 
-@api_router.get("/categories", response_model=List[Category])
+CATEGORY_STATS_TTL = int(os.environ.get('CATEGORY_STATS_TTL', 300))  # seconds between full refreshes
+
+# category_id -> {product_count, min_price, max_price}
+_category_stats: Dict[str, Dict[str, Any]] = {}
+_category_stats_loaded_at: Optional[datetime] = None
+
+async def _aggregate_category_stats(category_ids: Optional[set] = None) -> Dict[str, Dict[str, Any]]:
+    """Active product count and price range per category in one aggregation"""
+    match: Dict[str, Any] = {"is_active": True}
+    if category_ids is not None:
+        match["category_id"] = {"$in": list(category_ids)}
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": "$category_id",
+            "product_count": {"$sum": 1},
+            "min_price": {"$min": "$price"},
+            "max_price": {"$max": "$price"}
+        }}
+    ]
+    stats = {}
+    async for row in db.products.aggregate(pipeline):
+        stats[row['_id']] = {
+            "product_count": row['product_count'],
+            "min_price": row['min_price'],
+            "max_price": row['max_price']
+        }
+    return stats
+
+async def get_category_stats() -> Dict[str, Dict[str, Any]]:
+    global _category_stats, _category_stats_loaded_at
+    now = datetime.now(timezone.utc)
+    if _category_stats_loaded_at is None or (now - _category_stats_loaded_at).total_seconds() > CATEGORY_STATS_TTL:
+        _category_stats = await _aggregate_category_stats()
+        _category_stats_loaded_at = now
+    return _category_stats
+
+async def refresh_category_stats(*category_ids: Optional[str]):
+    """Recompute cached stats for the categories touched by a product write"""
+    if _category_stats_loaded_at is None:
+        return  # nothing cached yet, the next read loads everything
+    ids = {cid for cid in category_ids if cid}
+    if not ids:
+        return
+    fresh = await _aggregate_category_stats(ids)
+    for cid in ids:
+        if cid in fresh:
+            _category_stats[cid] = fresh[cid]
+        else:
+            _category_stats.pop(cid, None)
+
+@api_router.get("/categories", response_model=List[CategoryWithStats])
 async def get_categories():
     categories = await db.categories.find({"is_active": True}, {"_id": 0}).to_list(100)
+    stats = await get_category_stats()
     for cat in categories:
         if isinstance(cat.get('created_at'), str):
             cat['created_at'] = datetime.fromisoformat(cat['created_at'])
+        cat.update(stats.get(cat['id'], {"product_count": 0, "min_price": None, "max_price": None}))
     return categories
 
 @api_router.post("/categories", response_model=Category)
@@ -901,16 +1383,474 @@ async def delete_category(category_id: str, request: Request, response: Response
     await db.categories.delete_one({"id": category_id})
     return {"message": "Category deleted"}
 
+# ============= PRODUCT SEARCH =============
+
+FUZZY_SEARCH_LIMIT = 200  # ranked candidates handed to the listing query
+_SEARCH_WORD_RE = re.compile(r"\w+")
+_AZ_TRANSLITERATION = str.maketrans({
+    "ı": "i", "İ": "i", "I": "i", "ə": "e", "Ə": "e", "ş": "s", "Ş": "s",
+    "ç": "c", "Ç": "c", "ğ": "g", "Ğ": "g", "ö": "o", "Ö": "o", "ü": "u", "Ü": "u"
+})
+
+def normalize_search_text(text: str) -> str:
+    """Lowercase ASCII-folded text, so 'Ayaqqabı' and 'ayaqqabi' match"""
+    text = (text or "").translate(_AZ_TRANSLITERATION).lower()
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+def search_words(text: str) -> List[str]:
+    return _SEARCH_WORD_RE.findall(normalize_search_text(text))
+
+def word_trigrams(word: str) -> set:
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Optimal string alignment distance (adjacent swaps cost 1), capped at max_distance + 1"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if prev2 is not None and i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > max_distance:
+            return max_distance + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+class TrigramIndex:
+    """In-process typo-tolerant product search.
+
+    Trigrams point at vocabulary words and words point at products, so a query
+    term is matched against the (small) vocabulary first: candidates are
+    scored by trigram overlap, then ranked by edit distance. Each product's
+    listing filters (category, brand, price) are kept alongside so a filtered
+    search ranks only products that pass them. Short terms have
+    too few trigrams for overlap to mean much (a swap in "nkie" leaves one
+    shared with "nike"), so every word sharing a trigram goes to edit distance.
+    """
+    FIELD_WEIGHTS = {"title": 3, "brand": 3, "description": 1}
+    MAX_DESCRIPTION_WORDS = 60
+    MIN_SIMILARITY = 0.25
+    CANDIDATE_WORDS = 20
+    SHORT_TERM_LENGTH = 5
+
+    def __init__(self):
+        self._trigram_words: Dict[str, set] = defaultdict(set)
+        self._word_products: Dict[str, Dict[str, int]] = {}
+        self._product_words: Dict[str, set] = {}
+        self._product_facets: Dict[str, tuple] = {}
+        self.ready = False
+
+    def __len__(self):
+        return len(self._product_words)
+
+    def add(self, product: Dict[str, Any]):
+        product_id = product['id']
+        self.remove(product_id)
+        weights: Dict[str, int] = {}
+        for field, weight in self.FIELD_WEIGHTS.items():
+            words = search_words(product.get(field) or "")
+            if field == "description":
+                words = words[:self.MAX_DESCRIPTION_WORDS]
+            for word in words:
+                if weights.get(word, 0) < weight:
+                    weights[word] = weight
+        for word, weight in weights.items():
+            postings = self._word_products.get(word)
+            if postings is None:
+                postings = self._word_products[word] = {}
+                for gram in word_trigrams(word):
+                    self._trigram_words[gram].add(word)
+            postings[product_id] = weight
+        self._product_words[product_id] = set(weights)
+        self._product_facets[product_id] = (product.get('category_id'), product.get('brand'), product.get('price'))
+
+    def remove(self, product_id: str):
+        self._product_facets.pop(product_id, None)
+        for word in self._product_words.pop(product_id, ()):
+            postings = self._word_products.get(word)
+            if postings is None:
+                continue
+            postings.pop(product_id, None)
+            if not postings:
+                del self._word_products[word]
+                for gram in word_trigrams(word):
+                    words = self._trigram_words.get(gram)
+                    if words is not None:
+                        words.discard(word)
+                        if not words:
+                            del self._trigram_words[gram]
+
+    def _match_words(self, term: str) -> List[tuple]:
+        """(word, distance, similarity) for vocabulary words close to term"""
+        grams = word_trigrams(term)
+        overlap = Counter()
+        for gram in grams:
+            overlap.update(self._trigram_words.get(gram, ()))
+        short = len(term) <= self.SHORT_TERM_LENGTH
+        candidates = []
+        for word, shared in overlap.items():
+            similarity = shared / (len(grams) + len(word) + 1 - shared)
+            if short or similarity >= self.MIN_SIMILARITY:
+                candidates.append((similarity, word))
+        if not short:
+            candidates = heapq.nlargest(self.CANDIDATE_WORDS, candidates)
+        max_distance = max(1, len(term) // 3)
+        matches = []
+        for similarity, word in candidates:
+            if len(term) >= 3 and word.startswith(term):
+                distance = 0  # still typing
+            else:
+                distance = edit_distance(term, word, max_distance)
+            if distance <= max_distance:
+                matches.append((word, distance, similarity))
+        return matches
+
+    def _facets_match(
+        self,
+        product_id: str,
+        category_id: Optional[str],
+        brand: Optional[str],
+        min_price: Optional[float],
+        max_price: Optional[float]
+    ) -> bool:
+        category, product_brand, price = self._product_facets.get(product_id, (None, None, None))
+        if category_id and category != category_id:
+            return False
+        if brand and product_brand != brand:
+            return False
+        if min_price is not None and (price is None or price < min_price):
+            return False
+        if max_price is not None and (price is None or price > max_price):
+            return False
+        return True
+
+    def search(
+        self,
+        query: str,
+        limit: int = FUZZY_SEARCH_LIMIT,
+        category_id: Optional[str] = None,
+        brand: Optional[str] = None,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None
+    ) -> List[str]:
+        """Product ids passing the listing filters, ordered by matched terms, edit distance, field weight, overlap"""
+        filtered = category_id or brand or min_price is not None or max_price is not None
+        terms = search_words(query)
+        scores: Dict[str, list] = {}
+        for term in dict.fromkeys(terms):
+            best: Dict[str, tuple] = {}
+            for word, distance, similarity in self._match_words(term):
+                for product_id, weight in self._word_products.get(word, {}).items():
+                    if filtered and not self._facets_match(product_id, category_id, brand, min_price, max_price):
+                        continue
+                    key = (distance, -weight, -similarity)
+                    if product_id not in best or key < best[product_id]:
+                        best[product_id] = key
+            for product_id, (distance, neg_weight, neg_similarity) in best.items():
+                score = scores.setdefault(product_id, [0, 0, 0, 0.0])
+                score[0] += 1
+                score[1] += distance
+                score[2] -= neg_weight
+                score[3] -= neg_similarity
+        ranked = heapq.nsmallest(
+            limit, scores.items(),
+            key=lambda kv: (-kv[1][0], kv[1][1], -kv[1][2], -kv[1][3])
+        )
+        return [product_id for product_id, _ in ranked]
+
+product_search_index = TrigramIndex()
+_search_index_building: Optional[TrigramIndex] = None
+
+async def rebuild_search_index():
+    """Build a fresh index from active products and swap it in"""
+    global product_search_index, _search_index_building
+    index = TrigramIndex()
+    _search_index_building = index
+    try:
+        count = 0
+        async for prod in db.products.find(
+            {"is_active": True},
+            {"_id": 0, "id": 1, "title": 1, "brand": 1, "description": 1, "category_id": 1, "price": 1}
+        ):
+            index.add(prod)
+            count += 1
+            if count % 1000 == 0:
+                await asyncio.sleep(0)
+        index.ready = True
+        product_search_index = index
+        logging.info(f"Product search index built: {count} products")
+    except Exception as e:
+        logging.error(f"Product search index build failed: {e}")
+    finally:
+        _search_index_building = None
+
+def index_product_for_search(product: Dict[str, Any]):
+    """Apply a product write to the live index (and to one being rebuilt)"""
+    for index in (product_search_index, _search_index_building):
+        if index is None:
+            continue
+        if product.get('is_active', True):
+            index.add(product)
+        else:
+            index.remove(product['id'])
+
+def unindex_product_for_search(product_id: str):
+    for index in (product_search_index, _search_index_building):
+        if index is not None:
+            index.remove(product_id)
+
+# ============= PRODUCT COUNTERS =============
+
+PRODUCT_COUNTER_FLUSH_SECONDS = float(os.environ.get('PRODUCT_COUNTER_FLUSH_SECONDS', 10))
+POPULARITY_WEIGHTS = {"view_count": 1, "favorite_count": 5}
+
+class ProductCounterBuffer:
+    """Write-behind buffer for product view/favorite counters.
+
+    Events only touch an in-memory dict; flush() turns everything accumulated
+    since the last flush into one unordered bulk_write of $inc updates.
+    """
+
+    def __init__(self):
+        self._pending: Dict[str, Counter] = defaultdict(Counter)
+        self._lock = asyncio.Lock()
+
+    def record(self, product_id: str, field: str, amount: int = 1):
+        self._pending[product_id][field] += amount
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, defaultdict(Counter)
+            ops = []
+            for product_id, counts in pending.items():
+                inc = dict(counts)
+                inc["popularity"] = sum(POPULARITY_WEIGHTS[field] * n for field, n in counts.items())
+                ops.append(UpdateOne({"id": product_id}, {"$inc": inc}))
+            try:
+                await db.products.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                # Some updates were applied, retrying would double count them
+                logging.error(f"Product counter flush partially failed: {e.details.get('writeErrors')}")
+            except Exception as e:
+                logging.error(f"Product counter flush failed, keeping counts for next flush: {e}")
+                for product_id, counts in pending.items():
+                    self._pending[product_id].update(counts)
+                return 0
+            return len(ops)
+
+product_counters = ProductCounterBuffer()
+
+async def run_product_counter_flusher():
+    while True:
+        await asyncio.sleep(PRODUCT_COUNTER_FLUSH_SECONDS)
+        await product_counters.flush()
+
+# ============= SALES RANKING =============
+
+# A paid, non-cancelled order counts towards units sold and revenue of its
+# products: all-time on the product, and per day in product_sales_daily,
+# from which the rolling windows are refreshed.
+SALES_WINDOWS = {"7d": 7, "30d": 30}
+SALES_REFRESH_INTERVAL = float(os.environ.get('SALES_REFRESH_INTERVAL_SECONDS', 3600))
+SALES_ORDER_FIELDS = {"items.product_id": 1, "items.quantity": 1, "items.price": 1}
+
+def is_counted_sale(order: Optional[Dict[str, Any]]) -> bool:
+    return bool(order) and order.get('payment_status') == 'paid' and order.get('status') != 'cancelled'
+
+def order_sale_lines(order: Dict[str, Any]) -> Dict[str, List[float]]:
+    """product_id -> [units, revenue]"""
+    lines: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0])
+    for item in order.get('items') or []:
+        if not item.get('product_id'):
+            continue
+        quantity = int(item.get('quantity') or 1)
+        lines[item['product_id']][0] += quantity
+        lines[item['product_id']][1] += quantity * float(item.get('price') or 0)
+    return lines
+
+def sales_window_start(days: int, today: Optional[datetime] = None) -> str:
+    """First day (ISO date) inside a rolling window ending today"""
+    today = rollup_floor(today or datetime.now(timezone.utc), "day")
+    return (today - timedelta(days=days - 1)).date().isoformat()
+
+async def record_sales(order: Dict[str, Any], sign: int):
+    """Add (sign=1) or remove (sign=-1) an order's sales"""
+    lines = order_sale_lines(order)
+    if not lines:
+        return
+    day = rollup_floor(_as_datetime(order.get('created_at')) or datetime.now(timezone.utc), "day").date().isoformat()
+    windows = [window for window, days in SALES_WINDOWS.items() if day >= sales_window_start(days)]
+    product_ops, daily_ops = [], []
+    for product_id, (units, revenue) in lines.items():
+        inc = {"units_sold": sign * units, "sales_revenue": sign * revenue}
+        for window in windows:
+            inc[f"units_sold_{window}"] = sign * units
+            inc[f"sales_revenue_{window}"] = sign * revenue
+        product_ops.append(UpdateOne({"id": product_id}, {"$inc": inc}))
+        daily_ops.append(UpdateOne(
+            {"_id": f"{product_id}:{day}"},
+            {"$inc": {"units": sign * units, "revenue": sign * revenue},
+             "$setOnInsert": {"product_id": product_id, "day": day}},
+            upsert=True
+        ))
+    try:
+        await asyncio.gather(
+            db.products.bulk_write(product_ops, ordered=False),
+            db.product_sales_daily.bulk_write(daily_ops, ordered=False)
+        )
+    except Exception as e:
+        logging.error(f"Sales ranking update failed for order {order.get('id')}: {e}")
+
+async def record_sales_change(before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]):
+    was_sale, is_sale = is_counted_sale(before), is_counted_sale(after)
+    if was_sale != is_sale:
+        await record_sales(after if is_sale else before, 1 if is_sale else -1)
+
+async def refresh_sales_windows() -> Dict[str, Any]:
+    """Recompute the 7/30-day counters from the daily sales buckets.
+
+    Only the last 30 days of buckets are read; products whose sales fell out
+    of every window are reset to zero.
+    """
+    stamp = datetime.now(timezone.utc).isoformat()
+    starts = {window: sales_window_start(days) for window, days in SALES_WINDOWS.items()}
+    group: Dict[str, Any] = {"_id": "$product_id"}
+    for window, start in starts.items():
+        in_window = {"$gte": ["$day", start]}
+        group[f"units_sold_{window}"] = {"$sum": {"$cond": [in_window, "$units", 0]}}
+        group[f"sales_revenue_{window}"] = {"$sum": {"$cond": [in_window, "$revenue", 0]}}
+    rows = await db.product_sales_daily.aggregate([
+        {"$match": {"day": {"$gte": min(starts.values())}}},
+        {"$group": group}
+    ]).to_list(None)
+    
+    ops = [
+        UpdateOne({"id": row.pop('_id')}, {"$set": {**row, "sales_window_at": stamp}})
+        for row in rows
+    ]
+    for i in range(0, len(ops), 1000):
+        await db.products.bulk_write(ops[i:i + 1000], ordered=False)
+    window_fields = [f"{metric}_{window}" for window in SALES_WINDOWS for metric in ("units_sold", "sales_revenue")]
+    expired = await db.products.update_many(
+        {"sales_window_at": {"$ne": stamp}, "$or": [{field: {"$ne": 0}} for field in window_fields]},
+        {"$set": {**{field: 0 for field in window_fields}, "sales_window_at": stamp}}
+    )
+    return {"products": len(ops), "expired": expired.modified_count}
+
+async def run_sales_window_refresher():
+    while True:
+        try:
+            if await acquire_lease("sales_window_refresher", SALES_REFRESH_INTERVAL * 3):
+                await refresh_sales_windows()
+        except Exception as e:
+            logging.error(f"Sales window refresh error: {e}")
+        await asyncio.sleep(SALES_REFRESH_INTERVAL)
+
+async def rebuild_sales_ranking() -> Dict[str, Any]:
+    """Rebuild daily sales buckets and all-time counters from order history"""
+    sale_match = {"payment_status": "paid", "status": {"$ne": "cancelled"}}
+    sale_lines = [
+        {"$match": sale_match},
+        {"$project": {"_id": 0, "created_at": 1, **SALES_ORDER_FIELDS}},
+        {"$unwind": "$items"},
+        {"$match": {"items.product_id": {"$ne": None}}},
+    ]
+    quantity = {"$ifNull": ["$items.quantity", 1]}
+    rows = await db.orders.aggregate([
+        *sale_lines,
+        {"$unionWith": {"coll": "orders_archive", "pipeline": sale_lines}},
+        {"$group": {
+            "_id": {"product_id": "$items.product_id", "day": {"$substrCP": [_hour_of("$created_at"), 0, 10]}},
+            "units": {"$sum": quantity},
+            "revenue": {"$sum": {"$multiply": [quantity, {"$ifNull": ["$items.price", 0]}]}}
+        }}
+    ], allowDiskUse=True).to_list(None)
+    
+    stamp = datetime.now(timezone.utc).isoformat()
+    totals: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0])
+    daily_ops = []
+    for row in rows:
+        product_id, day = row['_id']['product_id'], row['_id']['day']
+        totals[product_id][0] += row['units']
+        totals[product_id][1] += row['revenue']
+        daily_ops.append(ReplaceOne(
+            {"_id": f"{product_id}:{day}"},
+            {"product_id": product_id, "day": day, "units": row['units'], "revenue": row['revenue'], "rebuilt_at": stamp},
+            upsert=True
+        ))
+    for i in range(0, len(daily_ops), 1000):
+        await db.product_sales_daily.bulk_write(daily_ops[i:i + 1000], ordered=False)
+    await db.product_sales_daily.delete_many({"rebuilt_at": {"$ne": stamp}})
+    
+    product_ops = [
+        UpdateOne({"id": product_id}, {"$set": {"units_sold": units, "sales_revenue": revenue, "sales_rebuilt_at": stamp}})
+        for product_id, (units, revenue) in totals.items()
+    ]
+    for i in range(0, len(product_ops), 1000):
+        await db.products.bulk_write(product_ops[i:i + 1000], ordered=False)
+    await db.products.update_many(
+        {"sales_rebuilt_at": {"$ne": stamp}, "$or": [{"units_sold": {"$ne": 0}}, {"sales_revenue": {"$ne": 0}}]},
+        {"$set": {"units_sold": 0, "sales_revenue": 0.0, "sales_rebuilt_at": stamp}}
+    )
+    windows = await refresh_sales_windows()
+    return {"products": len(totals), "daily_buckets": len(daily_ops), **windows}
+
+@api_router.get("/admin/products/best-sellers")
+async def get_best_sellers(
+    request: Request,
+    response: Response,
+    window: str = Query("all", pattern="^(all|7d|30d)$"),
+    by: str = Query("units", pattern="^(units|revenue)$"),
+    limit: int = 20
+):
+    """Products ranked by units sold or revenue, all-time or over the last 7/30 days (admin only)"""
+    await get_admin_user(request, response)
+    limit = max(1, min(limit, 100))
+    field = "units_sold" if by == "units" else "sales_revenue"
+    if window != "all":
+        field = f"{field}_{window}"
+    return await db.products.find(
+        {"is_active": True},
+        {"_id": 0, "id": 1, "title": 1, "price": 1, "stock": 1,
+         "units_sold": 1, "sales_revenue": 1,
+         **{f"{metric}_{w}": 1 for w in SALES_WINDOWS for metric in ("units_sold", "sales_revenue")}}
+    ).sort(field, -1).limit(limit).to_list(limit)
+
+@api_router.post("/admin/products/best-sellers/rebuild")
+async def run_sales_ranking_rebuild(request: Request, response: Response):
+    """Recount product sales from all paid orders (admin only)"""
+    await get_admin_user(request, response)
+    return await rebuild_sales_ranking()
+
 # ============= PRODUCT ROUTES =============
 
-@api_router.get("/products", response_model=List[Product])
-async def get_products(
+# Only orders that an index in INDEXES["products"] can serve
+PRODUCT_SORTS: Dict[str, List[tuple]] = {
+    "newest": [("created_at", DESCENDING)],
+    "price_asc": [("price", ASCENDING)],
+    "price_desc": [("price", DESCENDING)],
+    "rating": [("rating", DESCENDING)],
+    "popular": [("popularity", DESCENDING)],
+    "best_selling": [("units_sold", DESCENDING)],
+    "best_selling_30d": [("units_sold_30d", DESCENDING)],
+}
+
+def build_product_query(
     category_id: Optional[str] = None,
     min_price: Optional[float] = None,
     max_price: Optional[float] = None,
     brand: Optional[str] = None,
     search: Optional[str] = None
-):
+) -> Dict[str, Any]:
     query = {"is_active": True}
     if category_id:
         query["category_id"] = category_id
@@ -928,8 +1868,47 @@ async def get_products(
             {"title": {"$regex": search, "$options": "i"}},
             {"description": {"$regex": search, "$options": "i"}}
         ]
+    return query
+
+def get_product_sort(sort: Optional[str]) -> Optional[List[tuple]]:
+    if sort is None:
+        return None
+    if sort not in PRODUCT_SORTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid sort. Allowed: {', '.join(PRODUCT_SORTS)}"
+        )
+    return PRODUCT_SORTS[sort]
+
+@api_router.get("/products", response_model=List[Product])
+async def get_products(
+    category_id: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    brand: Optional[str] = None,
+    search: Optional[str] = None,
+    sort: Optional[str] = None,
+    fuzzy: bool = False
+):
+    sort_spec = get_product_sort(sort)
+    ranked_ids = None
+    if search and fuzzy and product_search_index.ready:
+        # Filter while ranking so the candidate cut keeps only listable products
+        ranked_ids = product_search_index.search(
+            search, category_id=category_id, brand=brand, min_price=min_price, max_price=max_price
+        )
+        query = build_product_query(category_id, min_price, max_price, brand)
+        query["id"] = {"$in": ranked_ids}
+    else:
+        query = build_product_query(category_id, min_price, max_price, brand, search)
     
-    products = await db.products.find(query, {"_id": 0}).to_list(1000)
+    cursor = db.products.find(query, {"_id": 0})
+    if sort_spec:
+        cursor = cursor.sort(sort_spec)
+    products = await cursor.to_list(1000)
+    if ranked_ids is not None and not sort_spec:
+        rank = {product_id: i for i, product_id in enumerate(ranked_ids)}
+        products.sort(key=lambda prod: rank[prod['id']])
     for prod in products:
         if isinstance(prod.get('created_at'), str):
             prod['created_at'] = datetime.fromisoformat(prod['created_at'])
@@ -942,34 +1921,237 @@ async def get_product(product_id: str):
         raise HTTPException(status_code=404, detail="Product not found")
     if isinstance(product.get('created_at'), str):
         product['created_at'] = datetime.fromisoformat(product['created_at'])
+    product_counters.record(product_id, "view_count")
     return product
 
+@api_router.get("/products/{product_id}/related")
+async def get_related_products(product_id: str):
+    """Customers also bought - precomputed by the co-purchase job"""
+    doc = await db.product_related.find_one({"product_id": product_id}, {"_id": 0})
+    if not doc:
+        return {"product_id": product_id, "related": [], "generated_at": None}
+    return doc
+
 @api_router.post("/products", response_model=Product)
 async def create_product(product: Product, request: Request, response: Response):
     await get_admin_user(request, response)  # Check admin authentication
     doc = product.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.products.insert_one(doc)
+    if doc.get('is_active'):
+        await bump_dashboard_stats({"total_products": 1})
+    await refresh_category_stats(product.category_id)
+    index_product_for_search(doc)
     return product
 
 @api_router.put("/products/{product_id}")
 async def update_product(product_id: str, updates: dict, request: Request, response: Response):
     await get_admin_user(request, response)  # Check admin authentication
-    await db.products.update_one({"id": product_id}, {"$set": updates})
+    previous = await db.products.find_one_and_update(
+        {"id": product_id},
+        {"$set": updates},
+        projection={"_id": 0, "category_id": 1, "is_active": 1}
+    )
+    if not previous:
+        raise HTTPException(status_code=404, detail="Product not found")
     
     # Return updated product
     updated_product = await db.products.find_one({"id": product_id}, {"_id": 0})
     if isinstance(updated_product.get('created_at'), str):
         updated_product['created_at'] = datetime.fromisoformat(updated_product['created_at'])
     
+    if bool(previous.get('is_active')) != bool(updated_product.get('is_active')):
+        await bump_dashboard_stats({"total_products": 1 if updated_product.get('is_active') else -1})
+    await refresh_category_stats(previous.get('category_id'), updated_product.get('category_id'))
+    index_product_for_search(updated_product)
     return updated_product
 
 @api_router.delete("/products/{product_id}")
 async def delete_product(product_id: str, request: Request, response: Response):
     await get_admin_user(request, response)  # Check admin authentication
-    await db.products.delete_one({"id": product_id})
+    deleted = await db.products.find_one_and_delete({"id": product_id}, projection={"_id": 0, "category_id": 1, "is_active": 1})
+    if deleted:
+        if deleted.get('is_active'):
+            await bump_dashboard_stats({"total_products": -1})
+        await refresh_category_stats(deleted.get('category_id'))
+    unindex_product_for_search(product_id)
     return {"message": "Product deleted"}
 
+# ============= CO-PURCHASE RECOMMENDATIONS =============
+
+RELATED_TOP_K = int(os.environ.get('RELATED_PRODUCTS_TOP_K', 20))
+RELATED_ORDER_BATCH = 10000  # orders folded into the sparse matrix per step
+RELATED_WRITE_BATCH = 1000
+RELATED_JOB_ID = "copurchase_recommendations"
+RELATED_JOB_TIMEOUT = int(os.environ.get('RELATED_JOB_TIMEOUT_SECONDS', 6 * 3600))  # a "running" job older than this is presumed dead
+
+_related_job: Optional[asyncio.Task] = None
+_related_executor: Optional[ProcessPoolExecutor] = None
+
+async def build_copurchase_recommendations(top_k: int = RELATED_TOP_K) -> Dict[str, Any]:
+    """Stream all orders and store the top-K co-purchased products per product.
+
+    Orders are read with a lean projection and folded into a sparse item-item
+    matrix every RELATED_ORDER_BATCH orders, so memory is bounded by the number
+    of distinct product pairs, not by the number of orders. CPU-bound: the
+    API runs it in a separate process through run_copurchase_job.
+    """
+    started_at = datetime.now(timezone.utc)
+    generated_at = started_at.isoformat()
+
+    # Dense index for every known product
+    product_index: Dict[str, int] = {}
+    async for prod in db.products.find({}, {"_id": 0, "id": 1}):
+        product_index[prod['id']] = len(product_index)
+    n = len(product_index)
+    if n == 0:
+        return {"orders": 0, "products": 0, "generated_at": generated_at}
+
+    cooccurrence = sparse.csr_matrix((n, n), dtype=np.float32)
+    item_counts = np.zeros(n, dtype=np.float32)
+    rows, cols = array('i'), array('i')
+    order_count = 0
+
+    def fold_batch():
+        nonlocal cooccurrence, rows, cols
+        if rows:
+            batch = sparse.coo_matrix(
+                (np.ones(len(rows), dtype=np.float32),
+                 (np.frombuffer(rows, dtype=np.int32), np.frombuffer(cols, dtype=np.int32))),
+                shape=(n, n)
+            ).tocsr()
+            cooccurrence = cooccurrence + batch
+        rows, cols = array('i'), array('i')
+
+    async for order in iterate_all_orders({"status": {"$ne": "cancelled"}}, {"_id": 0, "items.product_id": 1}):
+        order_count += 1
+        indices = sorted({
+            product_index[item['product_id']]
+            for item in order.get('items', [])
+            if isinstance(item, dict) and item.get('product_id') in product_index
+        })
+        for i in indices:
+            item_counts[i] += 1
+        for a in range(len(indices)):
+            for b in range(a + 1, len(indices)):
+                rows.extend((indices[a], indices[b]))
+                cols.extend((indices[b], indices[a]))
+        if order_count % RELATED_ORDER_BATCH == 0:
+            fold_batch()
+    fold_batch()
+
+    # Top-K neighbours per row, scored by cosine similarity of purchase vectors
+    product_ids = [None] * n
+    for pid, idx in product_index.items():
+        product_ids[idx] = pid
+
+    ops = []
+    written = 0
+    indptr, indices, data = cooccurrence.indptr, cooccurrence.indices, cooccurrence.data
+    for i in range(n):
+        start, end = indptr[i], indptr[i + 1]
+        if start == end:
+            continue
+        neighbours = indices[start:end]
+        counts = data[start:end]
+        scores = counts / np.sqrt(item_counts[i] * item_counts[neighbours])
+        if len(scores) > top_k:
+            top = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        ops.append(ReplaceOne(
+            {"product_id": product_ids[i]},
+            {
+                "product_id": product_ids[i],
+                "related": [
+                    {
+                        "product_id": product_ids[neighbours[j]],
+                        "score": round(float(scores[j]), 4),
+                        "count": int(counts[j])
+                    }
+                    for j in top
+                ],
+                "generated_at": generated_at
+            },
+            upsert=True
+        ))
+        if len(ops) >= RELATED_WRITE_BATCH:
+            await db.product_related.bulk_write(ops, ordered=False)
+            written += len(ops)
+            ops = []
+    if ops:
+        await db.product_related.bulk_write(ops, ordered=False)
+        written += len(ops)
+
+    # Drop neighbours of products that no longer co-occur
+    await db.product_related.delete_many({"generated_at": {"$ne": generated_at}})
+
+    return {
+        "orders": order_count,
+        "products": written,
+        "pairs": int(cooccurrence.nnz),
+        "generated_at": generated_at,
+        "duration_seconds": round((datetime.now(timezone.utc) - started_at).total_seconds(), 2)
+    }
+
+def run_copurchase_job(top_k: int = RELATED_TOP_K) -> Dict[str, Any]:
+    """Process entry point: build the recommendations on this process's own event loop and client"""
+    return asyncio.run(build_copurchase_recommendations(top_k))
+
+def related_executor() -> ProcessPoolExecutor:
+    # spawn, not fork: a forked child would inherit the parent's Mongo client sockets
+    global _related_executor
+    if _related_executor is None:
+        _related_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    return _related_executor
+
+async def claim_related_job() -> bool:
+    """Mark the job running in job_status unless some worker already runs it"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.job_status.find_one_and_replace(
+            {"_id": RELATED_JOB_ID, "$or": [
+                {"state": {"$ne": "running"}},
+                {"started_at": {"$lt": (now - timedelta(seconds=RELATED_JOB_TIMEOUT)).isoformat()}}
+            ]},
+            {"state": "running", "started_at": now.isoformat(), "worker": WORKER_ID},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False  # running on another worker
+    return True
+
+async def _run_related_job():
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(related_executor(), run_copurchase_job, RELATED_TOP_K)
+        status_doc = {"state": "finished", **result}
+        logging.info(f"Co-purchase recommendations rebuilt: {result}")
+    except Exception as e:
+        logging.error(f"Co-purchase job error: {e}")
+        status_doc = {"state": "failed", "error": str(e)}
+    await db.job_status.update_one(
+        {"_id": RELATED_JOB_ID},
+        {"$set": {**status_doc, "finished_at": datetime.now(timezone.utc).isoformat()}}
+    )
+
+@api_router.post("/admin/recommendations/rebuild")
+async def rebuild_recommendations(request: Request, response: Response):
+    """Start the co-purchase job in a background process (admin only)"""
+    global _related_job
+    await get_admin_user(request, response)
+    if not await claim_related_job():
+        status_doc = await db.job_status.find_one({"_id": RELATED_JOB_ID}, {"_id": 0})
+        return {"message": "Recommendation job already running", "status": status_doc}
+    _related_job = asyncio.create_task(_run_related_job())
+    return {"message": "Recommendation job started"}
+
+@api_router.get("/admin/recommendations/status")
+async def get_recommendations_status(request: Request, response: Response):
+    await get_admin_user(request, response)
+    return await db.job_status.find_one({"_id": RELATED_JOB_ID}, {"_id": 0}) or {"state": "idle"}
+
 # ============= COUPON ROUTES =============
 
 @api_router.get("/coupons")
@@ -1024,108 +2206,555 @@ async def delete_coupon(coupon_id: str, request: Request, response: Response):
     await db.coupons.delete_one({"id": coupon_id})
     return {"message": "Coupon deleted"}
 
-# ============= ORDER ROUTES =============
+# ============= ORDER TIMELINE =============
 
-@api_router.post("/orders", response_model=Order)
-async def create_order(order: Order):
-    from datetime import timedelta
-    
-    doc = order.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
-    doc['tracking_number'] = f"ATB{generate_short_id()}"
-    doc['status'] = 'confirmed'
-    
-    # Calculate real-time dates
+# Delivery schedules: (status, days after created_at, customer message).
+# Orders store only created_at + schedule_version; the timeline is expanded on read.
+ORDER_SCHEDULES: Dict[int, List[tuple]] = {
+    1: [
+        ("confirmed", 0, "Sifarişiniz təsdiqləndi"),
+        ("warehouse", 7, "Anbardan çıxdı"),
+        ("airplane", 12, "Təyyarəyə verildi"),
+        ("atabuy_warehouse", 16, "AtaBuy anbarına gətirildi"),
+        ("delivered", 20, "Ünvana çatdırıldı"),
+    ],
+}
+CURRENT_ORDER_SCHEDULE = 1
+ORDER_DATE_FIELDS = {
+    "warehouse": "warehouse_date",
+    "airplane": "airplane_date",
+    "atabuy_warehouse": "atabuy_date",
+    "delivered": "delivery_date",
+}
+
+def _as_datetime(value) -> datetime:
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+def compact_order_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop derived timeline fields before an order is stored"""
+    doc.pop('status_history', None)
+    for field in ORDER_DATE_FIELDS.values():
+        doc.pop(field, None)
+    doc['schedule_version'] = CURRENT_ORDER_SCHEDULE
+    return doc
+
+def expand_order_timeline(order: Dict[str, Any]) -> Dict[str, Any]:
+    """Fill planned dates and status_history from the order's schedule.
+
+    Dates an admin stored explicitly on the order take precedence.
+    """
+    schedule = ORDER_SCHEDULES.get(order.get('schedule_version'))
+    if not schedule or not order.get('created_at'):
+        return order
+    created_at = _as_datetime(order['created_at'])
+    history = []
+    for step, days, message in schedule:
+        date = created_at + timedelta(days=days)
+        field = ORDER_DATE_FIELDS.get(step)
+        if field:
+            if order.get(field):
+                date = _as_datetime(order[field])
+            else:
+                order[field] = date.isoformat()
+        history.append({"status": step, "date": date.isoformat(), "message": message})
+    if not order.get('status_history'):
+        order['status_history'] = history
+    return order
+
+async def _orders_storage_stats() -> Dict[str, Any]:
+    stats = await db.command("collStats", "orders")
+    return {"count": stats.get('count', 0), "avg_order_size": stats.get('avgObjSize', 0), "size": stats.get('size', 0)}
+
+async def migrate_order_timelines(batch_size: int = 500) -> Dict[str, Any]:
+    """Convert orders with a stored five-entry timeline to schedule_version 1"""
+    before = await _orders_storage_stats()
+    schedule = ORDER_SCHEDULES[1]
+    migrated = 0
+    ops = []
+    projection = {"_id": 0, "id": 1, "created_at": 1, **{field: 1 for field in ORDER_DATE_FIELDS.values()}}
+    async for order in db.orders.find(
+        {"schedule_version": {"$exists": False}, "status_history.0": {"$exists": True}},
+        projection
+    ):
+        if not order.get('created_at'):
+            continue
+        created_at = _as_datetime(order['created_at'])
+        unset = {"status_history": ""}
+        for step, days, _ in schedule:
+            field = ORDER_DATE_FIELDS.get(step)
+            if not field:
+                continue
+            stored = order.get(field)
+            planned = created_at + timedelta(days=days)
+            # Keep dates an admin moved away from the schedule
+            if not stored or abs((_as_datetime(stored) - planned).total_seconds()) < 60:
+                unset[field] = ""
+        ops.append(UpdateOne({"id": order['id']}, {"$set": {"schedule_version": 1}, "$unset": unset}))
+        if len(ops) >= batch_size:
+            await db.orders.bulk_write(ops, ordered=False)
+            migrated += len(ops)
+            ops = []
+    if ops:
+        await db.orders.bulk_write(ops, ordered=False)
+        migrated += len(ops)
+    after = await _orders_storage_stats()
+    return {"migrated": migrated, "before": before, "after": after}
+
+# ============= ORDER STATUS SCHEDULER =============
+
+ORDER_SCHEDULER_INTERVAL = float(os.environ.get('ORDER_SCHEDULER_INTERVAL_SECONDS', 300))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+order_scheduler_metrics: Dict[str, Any] = {
+    "worker_id": WORKER_ID,
+    "is_leader": False,
+    "ticks": 0,
+    "last_tick_at": None,
+    "last_tick_ms": None,
+    "last_moved": {},
+    "moved_total": {}
+}
+
+async def acquire_lease(name: str, ttl_seconds: float) -> bool:
+    """Take or renew a named lease; only one worker holds it until it expires"""
     now = datetime.now(timezone.utc)
-    warehouse_date = now + timedelta(days=7)
-    airplane_date = warehouse_date + timedelta(days=5)
-    atabuy_date = airplane_date + timedelta(days=4)
-    delivery_date = atabuy_date + timedelta(days=4)
-    
-    doc['warehouse_date'] = warehouse_date.isoformat()
-    doc['airplane_date'] = airplane_date.isoformat()
-    doc['atabuy_date'] = atabuy_date.isoformat()
-    doc['delivery_date'] = delivery_date.isoformat()
-    
-    # Status history
-    doc['status_history'] = [
-        {
-            'status': 'confirmed',
-            'date': now.isoformat(),
-            'message': 'Sifarişiniz təsdiqləndi'
-        },
-        {
-            'status': 'warehouse',
-            'date': warehouse_date.isoformat(),
-            'message': 'Anbardan çıxdı'
-        },
-        {
-            'status': 'airplane',
-            'date': airplane_date.isoformat(),
-            'message': 'Təyyarəyə verildi'
-        },
-        {
-            'status': 'atabuy_warehouse',
-            'date': atabuy_date.isoformat(),
-            'message': 'AtaBuy anbarına gətirildi'
-        },
-        {
-            'status': 'delivered',
-            'date': delivery_date.isoformat(),
-            'message': 'Ünvana çatdırıldı'
-        }
-    ]
-    
-    await db.orders.insert_one(doc)
-    
-    # Update stock
-    for item in order.items:
-        await db.products.update_one(
-            {"id": item['product_id']},
-            {"$inc": {"stock": -item['quantity']}}
+    try:
+        lease = await db.scheduler_leases.find_one_and_update(
+            {"_id": name, "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=ttl_seconds)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
         )
-    
-    return order
+    except DuplicateKeyError:
+        return False  # held by another worker
+    return lease is not None and lease.get('owner') == WORKER_ID
 
-@api_router.get("/orders/{order_id}")
-async def get_order(order_id: str):
-    order = await db.orders.find_one({"id": order_id}, {"_id": 0})
-    if not order:
-        raise HTTPException(status_code=404, detail="Order not found")
-    if isinstance(order.get('created_at'), str):
-        order['created_at'] = datetime.fromisoformat(order['created_at'])
-    if isinstance(order.get('updated_at'), str):
-        order['updated_at'] = datetime.fromisoformat(order['updated_at'])
+def order_status_transitions() -> List[tuple]:
+    """(schedule_version, from_status, to_status, days, date_field) in schedule order"""
+    transitions = []
+    for version, schedule in ORDER_SCHEDULES.items():
+        for (from_status, _, _), (to_status, days, _) in zip(schedule, schedule[1:]):
+            transitions.append((version, from_status, to_status, days, ORDER_DATE_FIELDS.get(to_status)))
+    return transitions
+
+async def advance_order_statuses() -> Dict[str, int]:
+    """One update_many per transition whose planned date has passed"""
+    now = datetime.now(timezone.utc)
+    moved = {}
+    for version, from_status, to_status, days, date_field in order_status_transitions():
+        due = {"created_at": {"$lte": (now - timedelta(days=days)).isoformat()}}
+        if date_field:
+            # An explicitly stored date overrides the schedule
+            due = {"$or": [
+                {date_field: {"$exists": False}, **due},
+                {date_field: {"$lte": now.isoformat()}}
+            ]}
+        result = await db.orders.update_many(
+            {"status": from_status, "schedule_version": version, **due},
+            {"$set": {"status": to_status, "updated_at": now.isoformat()}}
+        )
+        moved[f"{from_status}->{to_status}"] = result.modified_count
+        if result.modified_count:
+            await bump_dashboard_stats({
+                f"orders_by_status.{from_status}": -result.modified_count,
+                f"orders_by_status.{to_status}": result.modified_count
+            })
+    return moved
+
+async def run_order_scheduler():
+    metrics = order_scheduler_metrics
+    while True:
+        try:
+            metrics["is_leader"] = await acquire_lease("order_status_scheduler", ORDER_SCHEDULER_INTERVAL * 3)
+            if metrics["is_leader"]:
+                started = time.perf_counter()
+                moved = await advance_order_statuses()
+                metrics["ticks"] += 1
+                metrics["last_tick_at"] = datetime.now(timezone.utc).isoformat()
+                metrics["last_tick_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                metrics["last_moved"] = moved
+                for transition, count in moved.items():
+                    metrics["moved_total"][transition] = metrics["moved_total"].get(transition, 0) + count
+                logging.info(f"Order scheduler tick: moved={moved} took={metrics['last_tick_ms']}ms")
+        except Exception as e:
+            logging.error(f"Order scheduler error: {e}")
+        await asyncio.sleep(ORDER_SCHEDULER_INTERVAL)
+
+# ============= ORDER ARCHIVE =============
+
+ORDER_ARCHIVE_AFTER_DAYS = int(os.environ.get('ORDER_ARCHIVE_AFTER_DAYS', 180))
+ORDER_ARCHIVE_INTERVAL = float(os.environ.get('ORDER_ARCHIVE_INTERVAL_SECONDS', 3600))
+ORDER_ARCHIVE_BATCH = 500
+ARCHIVABLE_ORDER_STATUSES = ["delivered", "cancelled"]
+
+def order_archive_cutoff() -> str:
+    return (datetime.now(timezone.utc) - timedelta(days=ORDER_ARCHIVE_AFTER_DAYS)).isoformat()
+
+async def archive_orders() -> Dict[str, Any]:
+    """Move finished orders older than ORDER_ARCHIVE_AFTER_DAYS to orders_archive in batches.
+
+    Each batch is copied before it is deleted, and documents keep their _id,
+    so a run interrupted between the two steps is finished by the next one.
+    """
+    cutoff = order_archive_cutoff()
+    query = {"status": {"$in": ARCHIVABLE_ORDER_STATUSES}, "created_at": {"$lt": cutoff}}
+    archived = 0
+    while True:
+        batch = await db.orders.find(query).limit(ORDER_ARCHIVE_BATCH).to_list(ORDER_ARCHIVE_BATCH)
+        if not batch:
+            break
+        try:
+            await db.orders_archive.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            if any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+                raise
+        await db.orders.delete_many({"_id": {"$in": [order['_id'] for order in batch]}})
+        archived += len(batch)
+        await asyncio.sleep(0)
+    return {"archived": archived, "cutoff": cutoff}
+
+async def run_order_archiver():
+    while True:
+        try:
+            if await acquire_lease("order_archiver", ORDER_ARCHIVE_INTERVAL * 3):
+                result = await archive_orders()
+                if result['archived']:
+                    logging.info(f"Order archiver: {result}")
+        except Exception as e:
+            logging.error(f"Order archiver error: {e}")
+        await asyncio.sleep(ORDER_ARCHIVE_INTERVAL)
+
+async def iterate_all_orders(query: Dict[str, Any], projection: Dict[str, Any]):
+    """Stream archived then hot orders matching query"""
+    for collection in (db.orders_archive, db.orders):
+        async for order in collection.find(query, projection, batch_size=1000):
+            yield order
+
+async def find_order(query: Dict[str, Any], projection: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """Single order lookup, falling through to the archive on a miss"""
+    order = await db.orders.find_one(query, projection)
+    if order is None:
+        order = await db.orders_archive.find_one(query, projection)
     return order
 
-@api_router.get("/orders")
-async def get_orders(request: Request, response: Response):
-    await get_current_user(request, response)  # Check authentication
-    orders = await db.orders.find({}, {"_id": 0}).to_list(1000)
-    for order in orders:
-        if isinstance(order.get('created_at'), str):
-            order['created_at'] = datetime.fromisoformat(order['created_at'])
-        if isinstance(order.get('updated_at'), str):
-            order['updated_at'] = datetime.fromisoformat(order['updated_at'])
-    return orders
+async def find_orders_newest_first(query: Dict[str, Any], projection: Dict[str, Any], limit: int) -> List[Dict[str, Any]]:
+    """Up to limit orders across hot and archived tiers, sorted by (created_at, id) desc.
 
-@api_router.put("/orders/{order_id}")
-async def update_order(order_id: str, updates: dict, request: Request, response: Response):
-    await get_current_user(request, response)  # Check authentication
-    updates['updated_at'] = datetime.now(timezone.utc).isoformat()
-    await db.orders.update_one({"id": order_id}, {"$set": updates})
-    return {"message": "Order updated"}
+    Only orders older than the archive cutoff can be archived, so the archive
+    is skipped while the hot page is full and ends after the cutoff.
+    """
+    sort = [("created_at", -1), ("id", -1)]
+    orders = await db.orders.find(query, projection).sort(sort).limit(limit).to_list(limit)
+    if len(orders) == limit and (orders[-1].get('created_at') or '') >= order_archive_cutoff():
+        return orders
+    archived = await db.orders_archive.find(query, projection).sort(sort).limit(limit).to_list(limit)
+    if not archived:
+        return orders
+    merged = sorted(orders + archived, key=lambda o: (o.get('created_at') or '', o.get('id') or ''), reverse=True)
+    return merged[:limit]
 
-@api_router.post("/orders/{order_id}/cancel")
-async def cancel_order(order_id: str, cancellation_data: Dict[str, str], request: Request, response: Response):
-    """Cancel order (admin only)"""
-    admin = await get_admin_user(request, response)
-    
-    reason = cancellation_data.get('reason')
-    if not reason:
-        raise HTTPException(status_code=400, detail="Cancellation reason required")
-    
+# ============= STOCK RESERVATION =============
+
+class OutOfStockError(Exception):
+    def __init__(self, items: List[Dict[str, Any]]):
+        super().__init__("Insufficient stock")
+        self.items = items
+
+_supports_transactions: Optional[bool] = None
+
+async def supports_transactions() -> bool:
+    """Multi-document transactions need a replica set or a mongos"""
+    global _supports_transactions
+    if _supports_transactions is None:
+        try:
+            hello = await client.admin.command("hello")
+            _supports_transactions = bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+        except Exception as e:
+            logging.error(f"Could not detect replica set: {e}")
+            _supports_transactions = False
+    return _supports_transactions
+
+def validate_quantities(items: List[Dict[str, Any]]):
+    """Reject zero, negative or non-numeric quantities; a negative one would add stock"""
+    for item in items:
+        try:
+            quantity = int(item.get('quantity', 1))
+        except (TypeError, ValueError):
+            quantity = 0
+        if quantity < 1:
+            raise HTTPException(status_code=400, detail=f"Invalid quantity for product {item.get('product_id')}")
+
+def _stock_quantities(items: List[Dict[str, Any]]) -> Dict[str, int]:
+    quantities: Dict[str, int] = defaultdict(int)
+    for item in items:
+        if item.get('product_id'):
+            quantities[item['product_id']] += int(item.get('quantity', 1))
+    return dict(quantities)
+
+async def reserve_stock(items: List[Dict[str, Any]], session=None):
+    """Decrement stock for all items in one unordered bulk_write.
+
+    Every update is guarded by stock >= quantity. Outside a transaction each
+    update also tags the product with a reservation token, so a partial
+    failure can tell which products were decremented and restore them before
+    raising OutOfStockError. Inside one the caller's abort undoes them, so
+    the tag is skipped and the reservation stays a single bulk_write.
+    """
+    validate_quantities(items)
+    quantities = _stock_quantities(items)
+    if not quantities:
+        return
+    product_ids = list(quantities)
+    token = str(uuid.uuid4())
+    hold = {} if session is not None else {"$push": {"stock_holds": token}}
+    ops = [
+        UpdateOne(
+            {"id": product_id, "stock": {"$gte": qty}},
+            {"$inc": {"stock": -qty}, **hold}
+        )
+        for product_id, qty in quantities.items()
+    ]
+    result = await db.products.bulk_write(ops, ordered=False, session=session)
+    if result.modified_count == len(ops):
+        if session is None:
+            await db.products.update_many(
+                {"id": {"$in": product_ids}},
+                {"$pull": {"stock_holds": token}}
+            )
+        return
+    
+    if session is not None:
+        # Read outside the transaction: committed stock is still the pre-order
+        # value. If a restock landed meanwhile, report every item as short.
+        current = {
+            prod['id']: prod async for prod in db.products.find(
+                {"id": {"$in": product_ids}}, {"_id": 0, "id": 1, "title": 1, "stock": 1}
+            )
+        }
+        failing = [
+            product_id for product_id in product_ids
+            if current.get(product_id, {}).get('stock', 0) < quantities[product_id]
+        ] or product_ids
+    else:
+        held = {
+            prod['id'] async for prod in db.products.find(
+                {"id": {"$in": product_ids}, "stock_holds": token}, {"_id": 0, "id": 1}
+            )
+        }
+        failing = [product_id for product_id in product_ids if product_id not in held]
+        current = {
+            prod['id']: prod async for prod in db.products.find(
+                {"id": {"$in": failing}}, {"_id": 0, "id": 1, "title": 1, "stock": 1}
+            )
+        }
+        if held:
+            await db.products.bulk_write([
+                UpdateOne(
+                    {"id": product_id, "stock_holds": token},
+                    {"$inc": {"stock": quantities[product_id]}, "$pull": {"stock_holds": token}}
+                )
+                for product_id in held
+            ], ordered=False)
+    raise OutOfStockError([
+        {
+            "product_id": product_id,
+            "title": current.get(product_id, {}).get('title'),
+            "requested": quantities[product_id],
+            "available": max(current.get(product_id, {}).get('stock', 0), 0)
+        }
+        for product_id in failing
+    ])
+
+async def release_stock(items: List[Dict[str, Any]]):
+    quantities = _stock_quantities(items)
+    if quantities:
+        await db.products.bulk_write([
+            UpdateOne({"id": product_id}, {"$inc": {"stock": qty}})
+            for product_id, qty in quantities.items()
+        ], ordered=False)
+
+ORDER_ID_ATTEMPTS = 5
+
+def regenerate_order_ids(order_doc: Dict[str, Any], error: DuplicateKeyError) -> bool:
+    """Replace whichever generated ID collided; False if the duplicate is something else"""
+    key_pattern = (error.details or {}).get('keyPattern', {})
+    if 'id' in key_pattern:
+        order_doc['id'] = generate_order_id()
+        return True
+    if 'tracking_number' in key_pattern:
+        order_doc['tracking_number'] = generate_tracking_number()
+        return True
+    return False
+
+async def insert_order(order_doc: Dict[str, Any]):
+    """Insert an order, retrying with fresh IDs on the rare collision"""
+    for attempt in range(ORDER_ID_ATTEMPTS):
+        try:
+            await db.orders.insert_one(order_doc)
+            break
+        except DuplicateKeyError as e:
+            order_doc.pop('_id', None)
+            if attempt == ORDER_ID_ATTEMPTS - 1 or not regenerate_order_ids(order_doc, e):
+                raise
+    await record_order_change(None, order_doc)
+
+async def _place_order_once(order_doc: Dict[str, Any], items: List[Dict[str, Any]]):
+    if await supports_transactions():
+        async def reserve_and_insert(session):
+            await reserve_stock(items, session=session)
+            await db.orders.insert_one(order_doc, session=session)
+        
+        # with_transaction retries the whole callback on TransientTransactionError,
+        # e.g. the WriteConflict two checkouts of the same product run into
+        async with await client.start_session() as session:
+            await session.with_transaction(reserve_and_insert)
+        return
+    
+    await reserve_stock(items)
+    try:
+        await db.orders.insert_one(order_doc)
+    except Exception:
+        await release_stock(items)
+        raise
+
+async def place_order(order_doc: Dict[str, Any], items: List[Dict[str, Any]]):
+    """Reserve stock and insert the order, all-or-nothing.
+
+    An ID collision aborts the attempt (and its stock reservation), so the
+    whole step is retried with fresh IDs.
+    """
+    for attempt in range(ORDER_ID_ATTEMPTS):
+        try:
+            await _place_order_once(order_doc, items)
+            break
+        except DuplicateKeyError as e:
+            order_doc.pop('_id', None)
+            if attempt == ORDER_ID_ATTEMPTS - 1 or not regenerate_order_ids(order_doc, e):
+                raise
+    await record_order_change(None, order_doc)
+
+def out_of_stock_exception(error: OutOfStockError) -> HTTPException:
+    return HTTPException(
+        status_code=409,
+        detail={"message": "Some items are out of stock", "items": error.items}
+    )
+
+# ============= ORDER ROUTES =============
+
+@api_router.post("/orders", response_model=Order)
+async def create_order(order: Order, request: Request):
+    return await run_idempotent(request, "orders", lambda: place_new_order(order), response_model=Order)
+
+async def place_new_order(order: Order):
+    doc = compact_order_doc(order.model_dump())
+    doc['created_at'] = doc['created_at'].isoformat()
+    doc['updated_at'] = doc['updated_at'].isoformat()
+    doc['tracking_number'] = generate_tracking_number()
+    doc['status'] = 'confirmed'
+    
+    try:
+        await place_order(doc, order.items)
+    except OutOfStockError as e:
+        raise out_of_stock_exception(e)
+    
+    doc.pop('_id', None)
+    return expand_order_timeline(doc)
+
+@api_router.get("/orders/{order_id}")
+async def get_order(order_id: str):
+    order = await find_order({"id": order_id}, {"_id": 0})
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    expand_order_timeline(order)
+    if isinstance(order.get('created_at'), str):
+        order['created_at'] = datetime.fromisoformat(order['created_at'])
+    if isinstance(order.get('updated_at'), str):
+        order['updated_at'] = datetime.fromisoformat(order['updated_at'])
+    return order
+
+@api_router.get("/orders")
+async def get_orders(
+    request: Request,
+    response: Response,
+    order_status: Optional[str] = Query(None, alias="status"),
+    payment_status: Optional[str] = None,
+    email: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    archived: bool = False,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE
+):
+    """Admin order listing, newest first. Next page cursor and total count are sent as headers."""
+    await get_admin_user(request, response)
+    collection = db.orders_archive if archived else db.orders
+    limit = page_limit(limit)
+    
+    query: Dict[str, Any] = {}
+    if order_status:
+        query["status"] = order_status
+    if payment_status:
+        query["payment_status"] = payment_status
+    if email:
+        query["customer_email"] = email.strip()
+    created_range = date_range_filter(date_from, date_to)
+    if created_range:
+        query["created_at"] = created_range
+    
+    orders = await collection.find(apply_keyset(query, cursor), {"_id": 0}).sort(
+        [("created_at", -1), ("id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    next_cursor = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        next_cursor = encode_cursor(orders[-1].get('created_at'), orders[-1].get('id'))
+    set_page_headers(response, next_cursor, await cached_count(collection, query))
+    
+    for order in orders:
+        expand_order_timeline(order)
+        if isinstance(order.get('created_at'), str):
+            order['created_at'] = datetime.fromisoformat(order['created_at'])
+        if isinstance(order.get('updated_at'), str):
+            order['updated_at'] = datetime.fromisoformat(order['updated_at'])
+    return orders
+
+@api_router.post("/admin/migrations/order-timelines")
+async def run_order_timeline_migration(request: Request, response: Response):
+    """Replace stored order timelines with schedule references (admin only)"""
+    await get_admin_user(request, response)
+    return await migrate_order_timelines()
+
+@api_router.post("/admin/orders/archive")
+async def run_order_archive(request: Request, response: Response):
+    """Archive finished orders now instead of waiting for the next run (admin only)"""
+    await get_admin_user(request, response)
+    return await archive_orders()
+
+@api_router.get("/admin/scheduler/metrics")
+async def get_scheduler_metrics(request: Request, response: Response):
+    """Order status scheduler metrics for this worker (admin only)"""
+    await get_admin_user(request, response)
+    return order_scheduler_metrics
+
+@api_router.put("/orders/{order_id}")
+async def update_order(order_id: str, updates: dict, request: Request, response: Response):
+    await get_current_user(request, response)  # Check authentication
+    updates['updated_at'] = datetime.now(timezone.utc).isoformat()
+    before = await db.orders.find_one_and_update({"id": order_id}, {"$set": updates}, projection=ORDER_CHANGE_FIELDS)
+    if before:
+        await record_order_change(before, {**before, **{field: updates[field] for field in ('status', 'payment_status', 'total') if field in updates}})
+    invalidate_tracking_cache(order_id)
+    return {"message": "Order updated"}
+
+@api_router.post("/orders/{order_id}/cancel")
+async def cancel_order(order_id: str, cancellation_data: Dict[str, str], request: Request, response: Response):
+    """Cancel order (admin only)"""
+    admin = await get_admin_user(request, response)
+    
+    reason = cancellation_data.get('reason')
+    if not reason:
+        raise HTTPException(status_code=400, detail="Cancellation reason required")
+    
     # Check if order exists
     order = await db.orders.find_one({"id": order_id})
     if not order:
@@ -1137,8 +2766,8 @@ async def cancel_order(order_id: str, cancellation_data: Dict[str, str], request
     
     # Update order
     now = datetime.now(timezone.utc)
-    await db.orders.update_one(
-        {"id": order_id},
+    result = await db.orders.update_one(
+        {"id": order_id, "status": {"$ne": "cancelled"}},
         {
             "$set": {
                 "status": "cancelled",
@@ -1149,9 +2778,57 @@ async def cancel_order(order_id: str, cancellation_data: Dict[str, str], request
             }
         }
     )
+    if result.modified_count:
+        await record_order_change(order, {**order, "status": "cancelled"})
+    invalidate_tracking_cache(order_id)
     
     return {"message": "Order cancelled successfully"}
 
+# ============= ORDER TRACKING =============
+
+TRACKING_CACHE_TTL = int(os.environ.get('TRACKING_CACHE_TTL', 30))
+# Timeline fields only - never customer name, contact, address or items
+TRACKING_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "tracking_number": 1,
+    "status": 1,
+    "created_at": 1,
+    "updated_at": 1,
+    "schedule_version": 1,
+    "status_history": 1,
+    "cancelled_at": 1,
+    **{field: 1 for field in ORDER_DATE_FIELDS.values()}
+}
+
+_tracking_cache: TTLCache = TTLCache(maxsize=10000, ttl=TRACKING_CACHE_TTL)
+_tracking_numbers_by_order: TTLCache = TTLCache(maxsize=10000, ttl=TRACKING_CACHE_TTL)
+
+def invalidate_tracking_cache(order_id: str):
+    tracking_number = _tracking_numbers_by_order.pop(order_id, None)
+    if tracking_number:
+        _tracking_cache.pop(tracking_number, None)
+
+@api_router.get("/track/{tracking_number}")
+async def track_order(tracking_number: str):
+    """Public shipping progress by tracking number"""
+    cached = _tracking_cache.get(tracking_number)
+    if cached is not None:
+        return cached
+    
+    order = await find_order({"tracking_number": tracking_number}, TRACKING_PROJECTION)
+    if not order:
+        raise HTTPException(status_code=404, detail="Tracking number not found")
+    # The order id opens the full order, so it is not exposed here
+    order_id = order.pop('id', None)
+    expand_order_timeline(order)
+    order.pop('schedule_version', None)
+    
+    _tracking_cache[tracking_number] = order
+    if order_id:
+        _tracking_numbers_by_order[order_id] = tracking_number
+    return order
+
 # ============= REVIEW ROUTES =============
 
 @api_router.get("/reviews/{product_id}")
@@ -1303,70 +2980,538 @@ async def get_chat_history(session_id: str):
 
 # ============= ADMIN STATS =============
 
+# Only the fields the stats need, so base64 item images never leave the server
+_ORDER_STATS_FIELDS = {"$project": {"_id": 0, "status": 1, "payment_status": 1, "total": 1}}
+
+async def compute_order_stats() -> Dict[str, Any]:
+    """Order counts by status, pending counts and paid revenue over hot and archived orders in one aggregation"""
+    pipeline = [
+        _ORDER_STATS_FIELDS,
+        {"$unionWith": {"coll": "orders_archive", "pipeline": [_ORDER_STATS_FIELDS]}},
+        {"$facet": {
+            "by_status": [
+                {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+            ],
+            "paid": [
+                {"$match": {"payment_status": "paid"}},
+                {"$group": {"_id": None, "revenue": {"$sum": "$total"}, "count": {"$sum": 1}}}
+            ],
+            "pending_payment": [
+                {"$match": {"payment_status": "pending"}},
+                {"$count": "count"}
+            ]
+        }}
+    ]
+    result = (await db.orders.aggregate(pipeline).to_list(1))[0]
+    by_status = {row['_id'] or "unknown": row['count'] for row in result['by_status']}
+    paid = result['paid'][0] if result['paid'] else {"revenue": 0, "count": 0}
+    return {
+        "total_orders": sum(by_status.values()),
+        "total_revenue": round(paid['revenue'] or 0, 2),
+        "paid_orders": paid['count'],
+        "pending_orders": by_status.get("pending", 0),
+        "pending_payment_orders": result['pending_payment'][0]['count'] if result['pending_payment'] else 0,
+        "orders_by_status": by_status
+    }
+
+# ============= DASHBOARD COUNTERS =============
+
+DASHBOARD_STATS_ID = "dashboard"
+DASHBOARD_RECONCILE_INTERVAL = float(os.environ.get('DASHBOARD_RECONCILE_INTERVAL_SECONDS', 900))
+# Fields record_order_change needs from an order's previous state
+ORDER_CHANGE_FIELDS = {
+    "_id": 0, "id": 1, "status": 1, "payment_status": 1, "total": 1, "created_at": 1, "customer_email": 1,
+    **SALES_ORDER_FIELDS
+}
+DASHBOARD_COUNTERS = ["total_products", "total_users", "total_orders", "total_revenue", "paid_orders", "pending_payment_orders"]
+
+def _order_counters(order: Optional[Dict[str, Any]]) -> Dict[str, float]:
+    """What one order contributes to the dashboard counters"""
+    if not order:
+        return {}
+    counters = {"total_orders": 1, f"orders_by_status.{order.get('status') or 'unknown'}": 1}
+    if order.get('payment_status') == 'paid':
+        counters['paid_orders'] = 1
+        counters['total_revenue'] = order.get('total') or 0
+    elif order.get('payment_status') == 'pending':
+        counters['pending_payment_orders'] = 1
+    return counters
+
+def order_stats_delta(before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]) -> Dict[str, float]:
+    """Counter increments for an order going from before to after (None = absent)"""
+    delta = Counter(_order_counters(after))
+    delta.subtract(_order_counters(before))
+    return {key: value for key, value in delta.items() if value}
+
+async def bump_dashboard_stats(inc: Dict[str, float]):
+    """Apply counter increments; a failure only logs, reconciliation repairs the drift"""
+    if not inc:
+        return
+    try:
+        await db.dashboard_stats.update_one(
+            {"_id": DASHBOARD_STATS_ID},
+            {"$inc": inc, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+    except Exception as e:
+        logging.error(f"Dashboard counter update failed {inc}: {e}")
+
+async def record_order_change(before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]):
+    await record_order_changes([(before, after)])
+
+async def record_order_changes(changes: List[tuple]):
+    """record_order_change for many (before, after) pairs, with one counter and one rollup write"""
+    inc: Counter = Counter()
+    events = []
+    for before, after in changes:
+        inc.update(order_stats_delta(before, after))
+        events.extend(order_rollup_events(before, after))
+    await asyncio.gather(
+        bump_dashboard_stats({key: value for key, value in inc.items() if value}),
+        bump_rollups(events)
+    )
+    # Only orders that became or stopped being sales touch products and referrals
+    flips = [(before, after) for before, after in changes if is_counted_sale(before) != is_counted_sale(after)]
+    for i in range(0, len(flips), 100):
+        await asyncio.gather(*(
+            coro for before, after in flips[i:i + 100]
+            for coro in (record_sales_change(before, after), record_referral_conversion(before, after))
+        ))
+
+async def record_user_signup():
+    await asyncio.gather(
+        bump_dashboard_stats({"total_users": 1}),
+        bump_rollups([(datetime.now(timezone.utc), {"new_users": 1})])
+    )
+
+async def reconcile_dashboard_stats() -> Dict[str, Any]:
+    """Recompute the counters from the collections and replace the stats document.
+
+    Increments landing while the recount runs can be lost or counted twice;
+    the next reconciliation corrects them.
+    """
+    total_products, total_users, order_stats = await asyncio.gather(
+        db.products.count_documents({"is_active": True}),
+        db.users.count_documents({"role": "user"}),
+        compute_order_stats()
+    )
+    order_stats.pop('pending_orders')
+    now = datetime.now(timezone.utc).isoformat()
+    stats = {"total_products": total_products, "total_users": total_users, **order_stats, "reconciled_at": now, "updated_at": now}
+    previous = await db.dashboard_stats.find_one_and_replace(
+        {"_id": DASHBOARD_STATS_ID}, stats, upsert=True, projection={"_id": 0}
+    ) or {}
+    drift = {
+        counter: round(stats[counter] - (previous.get(counter) or 0), 2)
+        for counter in DASHBOARD_COUNTERS
+        if round(stats[counter] - (previous.get(counter) or 0), 2)
+    }
+    if previous and drift:
+        logging.warning(f"Dashboard counters drifted: {drift}")
+    return {"stats": stats, "drift": drift}
+
+async def run_dashboard_reconciler():
+    while True:
+        try:
+            if await acquire_lease("dashboard_reconciler", DASHBOARD_RECONCILE_INTERVAL * 3):
+                await reconcile_dashboard_stats()
+        except Exception as e:
+            logging.error(f"Dashboard reconciler error: {e}")
+        await asyncio.sleep(DASHBOARD_RECONCILE_INTERVAL)
+
+async def read_dashboard_stats() -> Dict[str, Any]:
+    stats = await db.dashboard_stats.find_one({"_id": DASHBOARD_STATS_ID}, {"_id": 0})
+    if not stats or 'reconciled_at' not in stats:
+        stats = (await reconcile_dashboard_stats())['stats']
+    by_status = {status: count for status, count in (stats.get('orders_by_status') or {}).items() if count}
+    return {
+        **{counter: stats.get(counter) or 0 for counter in DASHBOARD_COUNTERS},
+        "total_revenue": round(stats.get('total_revenue') or 0, 2),
+        "pending_orders": by_status.get("pending", 0),
+        "orders_by_status": by_status,
+        "updated_at": stats.get('updated_at')
+    }
+
+ADMIN_STATS_CACHE_TTL = float(os.environ.get('ADMIN_STATS_CACHE_TTL', 15))
+ADMIN_STATS_STALE_TTL = float(os.environ.get('ADMIN_STATS_STALE_TTL', 300))
+
+class StaleWhileRevalidate:
+    """Cache for one computed value.
+
+    Fresh for ttl seconds; after that, until stale_ttl, the old value is
+    served while a background task recomputes it. Only one recompute runs at
+    a time, and callers with nothing usable to serve wait on that same task.
+    """
+    def __init__(self, loader, ttl: float, stale_ttl: float):
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl, ttl)
+        self.value = None
+        self.loaded_at: Optional[float] = None
+        self._refresh: Optional[asyncio.Task] = None
+    
+    async def get(self):
+        age = None if self.loaded_at is None else time.monotonic() - self.loaded_at
+        if age is not None and age < self.ttl:
+            return self.value
+        refresh = self._start_refresh()
+        if age is not None and age < self.stale_ttl:
+            return self.value
+        return await asyncio.shield(refresh)
+    
+    def invalidate(self):
+        self.loaded_at = None
+    
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self._load())
+            self._refresh.add_done_callback(self._log_failure)
+        return self._refresh
+    
+    async def _load(self):
+        value = await self.loader()
+        self.value, self.loaded_at = value, time.monotonic()
+        return value
+    
+    @staticmethod
+    def _log_failure(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logging.error(f"Cache refresh failed: {task.exception()}")
+
+async def load_admin_stats() -> Dict[str, Any]:
+    stats, top_products = await asyncio.gather(
+        read_dashboard_stats(),
+        # Best sellers
+        db.products.find(
+            {"is_active": True},
+            {"_id": 0, "id": 1, "title": 1, "price": 1, "stock": 1, "rating": 1, "units_sold": 1, "sales_revenue": 1}
+        ).sort("units_sold", -1).limit(5).to_list(5)
+    )
+    return {**stats, "top_products": top_products}
+
+admin_stats_cache = StaleWhileRevalidate(load_admin_stats, ADMIN_STATS_CACHE_TTL, ADMIN_STATS_STALE_TTL)
+
 @api_router.get("/admin/stats")
 async def get_admin_stats(request: Request, response: Response):
     await get_admin_user(request, response)  # Check admin authentication
-    total_products = await db.products.count_documents({"is_active": True})
-    total_orders = await db.orders.count_documents({})
-    total_users = await db.users.count_documents({"role": "user"})
-    total_revenue = 0
+    return await admin_stats_cache.get()
+
+@api_router.post("/admin/stats/reconcile")
+async def run_dashboard_reconcile(request: Request, response: Response):
+    """Recount dashboard counters now and report the drift that was corrected (admin only)"""
+    await get_admin_user(request, response)
+    result = await reconcile_dashboard_stats()
+    admin_stats_cache.invalidate()
+    return {"drift": result['drift'], "reconciled_at": result['stats']['reconciled_at']}
+
+# ============= STATS ROLLUPS =============
+
+# Bucket documents are keyed "<granularity>:<start>", so a time range is a
+# range scan on _id; start is the UTC bucket start in created_at's ISO format.
+ROLLUP_GRANULARITIES = ["hour", "day"]
+ROLLUP_METRICS = ["orders", "revenue", "cancellations", "new_users"]
+# interval -> (source granularity, default span)
+TIMESERIES_INTERVALS = {
+    "hour": ("hour", timedelta(hours=48)),
+    "day": ("day", timedelta(days=30)),
+    "week": ("day", timedelta(weeks=12)),
+    "month": ("day", timedelta(days=365)),
+}
+TIMESERIES_MAX_POINTS = 2000
+
+def rollup_floor(value: datetime, interval: str) -> datetime:
+    value = value.astimezone(timezone.utc) if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if interval == "hour":
+        return value.replace(minute=0, second=0, microsecond=0)
+    day = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == "week":
+        return day - timedelta(days=day.weekday())
+    if interval == "month":
+        return day.replace(day=1)
+    return day
+
+def rollup_next(start: datetime, interval: str) -> datetime:
+    if interval == "month":
+        return (start + timedelta(days=32)).replace(day=1)
+    return start + {"hour": timedelta(hours=1), "day": timedelta(days=1), "week": timedelta(weeks=1)}[interval]
+
+def rollup_bucket_id(granularity: str, start: datetime) -> str:
+    return f"{granularity}:{start.isoformat()}"
+
+def _order_rollup_counters(order: Optional[Dict[str, Any]]) -> Dict[str, float]:
+    if not order:
+        return {}
+    counters = {"orders": 1}
+    if order.get('payment_status') == 'paid':
+        counters['revenue'] = order.get('total') or 0
+    return counters
+
+def order_rollup_events(before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]) -> List[tuple]:
+    """(time, increments) pairs for an order change.
+
+    Orders and revenue count in the bucket the order was created in,
+    cancellations in the bucket they happened in.
+    """
+    events = []
+    created = Counter(_order_rollup_counters(after))
+    created.subtract(_order_rollup_counters(before))
+    created = {metric: value for metric, value in created.items() if value}
+    if created:
+        created_at = _as_datetime((after or before).get('created_at')) or datetime.now(timezone.utc)
+        events.append((created_at, created))
+    was_cancelled = bool(before) and before.get('status') == 'cancelled'
+    is_cancelled = bool(after) and after.get('status') == 'cancelled'
+    if was_cancelled != is_cancelled:
+        events.append((datetime.now(timezone.utc), {"cancellations": 1 if is_cancelled else -1}))
+    return events
+
+async def bump_rollups(events: List[tuple]):
+    """$inc the hourly and daily buckets for each (time, increments) event"""
+    ops = []
+    for when, inc in events:
+        for granularity in ROLLUP_GRANULARITIES:
+            start = rollup_floor(when, granularity)
+            ops.append(UpdateOne(
+                {"_id": rollup_bucket_id(granularity, start)},
+                {"$inc": inc, "$setOnInsert": {"granularity": granularity, "start": start.isoformat()}},
+                upsert=True
+            ))
+    if not ops:
+        return
+    try:
+        await db.stats_rollups.bulk_write(ops, ordered=False)
+    except Exception as e:
+        logging.error(f"Stats rollup update failed {events}: {e}")
+
+def _hour_of(field: str) -> Dict[str, Any]:
+    """"YYYY-MM-DDTHH" of a stored UTC ISO string, or of a BSON date in older documents"""
+    return {"$cond": [
+        {"$eq": [{"$type": field}, "string"]},
+        {"$substrCP": [field, 0, 13]},
+        {"$dateToString": {"format": "%Y-%m-%dT%H", "date": field}}
+    ]}
+
+async def backfill_rollups() -> Dict[str, Any]:
+    """Rebuild every hourly and daily bucket from orders (hot and archived) and users.
+
+    History is grouped per hour in MongoDB and days are summed from the
+    hours. Live increments that land while a backfill runs can be overwritten.
+    """
+    started = datetime.now(timezone.utc)
+    order_fields = {"_id": 0, "created_at": 1, "payment_status": 1, "total": 1}
+    cancelled_fields = {"_id": 0, "at": {"$ifNull": ["$cancelled_at", {"$ifNull": ["$updated_at", "$created_at"]}]}}
+    created_pipeline = [
+        {"$match": {"created_at": {"$ne": None}}},
+        {"$project": order_fields},
+        {"$unionWith": {"coll": "orders_archive", "pipeline": [{"$match": {"created_at": {"$ne": None}}}, {"$project": order_fields}]}},
+        {"$group": {
+            "_id": _hour_of("$created_at"),
+            "orders": {"$sum": 1},
+            "revenue": {"$sum": {"$cond": [{"$eq": ["$payment_status", "paid"]}, {"$ifNull": ["$total", 0]}, 0]}}
+        }}
+    ]
+    cancelled_pipeline = [
+        {"$match": {"status": "cancelled"}},
+        {"$project": cancelled_fields},
+        {"$unionWith": {"coll": "orders_archive", "pipeline": [{"$match": {"status": "cancelled"}}, {"$project": cancelled_fields}]}},
+        {"$match": {"at": {"$ne": None}}},
+        {"$group": {"_id": _hour_of("$at"), "cancellations": {"$sum": 1}}}
+    ]
+    users_pipeline = [
+        {"$match": {"created_at": {"$ne": None}}},
+        {"$group": {"_id": _hour_of("$created_at"), "new_users": {"$sum": 1}}}
+    ]
+    rows = await asyncio.gather(
+        db.orders.aggregate(created_pipeline, allowDiskUse=True).to_list(None),
+        db.orders.aggregate(cancelled_pipeline, allowDiskUse=True).to_list(None),
+        db.users.aggregate(users_pipeline, allowDiskUse=True).to_list(None)
+    )
     
-    orders = await db.orders.find({"payment_status": "paid"}).to_list(10000)
-    for order in orders:
-        total_revenue += order.get('total', 0)
+    buckets: Dict[tuple, Counter] = defaultdict(Counter)
+    for row in (row for group in rows for row in group):
+        hour = datetime.fromisoformat(f"{row.pop('_id')}:00:00+00:00")
+        for granularity in ROLLUP_GRANULARITIES:
+            buckets[(granularity, rollup_floor(hour, granularity))].update(row)
     
-    pending_orders = await db.orders.count_documents({"status": "pending"})
+    stamp = started.isoformat()
+    ops = [
+        ReplaceOne(
+            {"_id": rollup_bucket_id(granularity, start)},
+            {"granularity": granularity, "start": start.isoformat(), "backfilled_at": stamp,
+             **{metric: counts.get(metric, 0) for metric in ROLLUP_METRICS}},
+            upsert=True
+        )
+        for (granularity, start), counts in buckets.items()
+    ]
+    for i in range(0, len(ops), 1000):
+        await db.stats_rollups.bulk_write(ops[i:i + 1000], ordered=False)
+    # Buckets with no history left (e.g. deleted orders), but not ones opened since the run began
+    stale = await db.stats_rollups.delete_many({
+        "backfilled_at": {"$ne": stamp},
+        "start": {"$lt": rollup_floor(started, "hour").isoformat()}
+    })
+    return {"buckets": len(ops), "removed": stale.deleted_count, "backfilled_at": stamp}
+
+async def get_rollup_timeseries(interval: str, date_from: datetime, date_to: datetime) -> Dict[str, Any]:
+    granularity = TIMESERIES_INTERVALS[interval][0]
+    starts = []
+    point = rollup_floor(date_from, interval)
+    while point <= date_to:
+        starts.append(point)
+        if len(starts) > TIMESERIES_MAX_POINTS:
+            raise HTTPException(status_code=400, detail=f"Range exceeds {TIMESERIES_MAX_POINTS} {interval} buckets")
+        point = rollup_next(point, interval)
+    if not starts:
+        raise HTTPException(status_code=400, detail="date_from must be before date_to")
     
-    # Top products
-    top_products = await db.products.find(
-        {"is_active": True},
-        {"_id": 0, "title": 1, "price": 1, "stock": 1, "rating": 1}
-    ).sort("rating", -1).limit(5).to_list(5)
+    buckets = await db.stats_rollups.find(
+        {"_id": {
+            "$gte": rollup_bucket_id(granularity, rollup_floor(starts[0], granularity)),
+            "$lt": rollup_bucket_id(granularity, rollup_next(starts[-1], interval))
+        }},
+        {"_id": 0, "start": 1, **{metric: 1 for metric in ROLLUP_METRICS}}
+    ).to_list(None)
     
-    return {
-        "total_products": total_products,
-        "total_orders": total_orders,
-        "total_users": total_users,
-        "total_revenue": round(total_revenue, 2),
-        "pending_orders": pending_orders,
-        "top_products": top_products
-    }
+    index = {start: i for i, start in enumerate(starts)}
+    series = {metric: [0] * len(starts) for metric in ROLLUP_METRICS}
+    for bucket in buckets:
+        i = index.get(rollup_floor(datetime.fromisoformat(bucket['start']), interval))
+        if i is None:
+            continue
+        for metric in ROLLUP_METRICS:
+            series[metric][i] += bucket.get(metric) or 0
+    series['revenue'] = [round(value, 2) for value in series['revenue']]
+    return {"interval": interval, "buckets": [start.isoformat() for start in starts], **series}
+
+@api_router.get("/admin/stats/timeseries")
+async def get_stats_timeseries(
+    request: Request,
+    response: Response,
+    interval: str = "day",
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None
+):
+    """Orders, revenue, cancellations and new users per hour/day/week/month as chart-ready arrays (admin only)"""
+    await get_admin_user(request, response)
+    if interval not in TIMESERIES_INTERVALS:
+        raise HTTPException(status_code=400, detail=f"interval must be one of: {', '.join(TIMESERIES_INTERVALS)}")
+    date_to = rollup_floor(date_to or datetime.now(timezone.utc), "hour")
+    date_from = date_from or date_to - TIMESERIES_INTERVALS[interval][1]
+    return await get_rollup_timeseries(interval, date_from, date_to)
+
+@api_router.post("/admin/stats/rollups/backfill")
+async def run_rollup_backfill(request: Request, response: Response):
+    """Rebuild the hourly/daily stats buckets from order and user history (admin only)"""
+    await get_admin_user(request, response)
+    return await backfill_rollups()
+
+@api_router.get("/admin/products/popularity")
+async def get_product_popularity(request: Request, response: Response, limit: int = 20):
+    """Most viewed/favorited products (admin only)"""
+    await get_admin_user(request, response)
+    limit = max(1, min(limit, 100))
+    return await db.products.find(
+        {"is_active": True},
+        {"_id": 0, "id": 1, "title": 1, "view_count": 1, "favorite_count": 1, "popularity": 1}
+    ).sort("popularity", -1).limit(limit).to_list(limit)
 
 # ============= ADMIN USER MANAGEMENT =============
 
+# Lowercased/normalized copies of the searchable fields, each with its own index
+USER_SEARCH_SOURCES = {"email_lower": "email", "name_lower": "name", "phone_digits": "phone"}
+
+# Table columns only: no password hash, favorites or cards, and uploaded
+# (base64) avatars are left for the detail view
+USER_LIST_PROJECTION = {
+    "_id": 1, "id": 1, "email": 1, "name": 1, "phone": 1, "role": 1,
+    "address": 1, "city": 1, "postal_code": 1, "referral_code": 1, "referral_bonus": 1, "created_at": 1,
+    "picture": {"$cond": [
+        {"$regexMatch": {"input": {"$ifNull": ["$picture", ""]}, "regex": "^data:"}}, None, "$picture"
+    ]}
+}
+
+def phone_search_digits(phone: Optional[str]) -> str:
+    """Digits without the +994 / 0 prefix, so local and international forms match"""
+    digits = re.sub(r'\D', '', phone or '')
+    for prefix in ("994", "0"):
+        if digits.startswith(prefix):
+            return digits[len(prefix):]
+    return digits
+
+def user_search_fields(fields: Dict[str, Any]) -> Dict[str, str]:
+    """Search keys for whichever of email/name/phone are being written"""
+    search = {}
+    if 'email' in fields:
+        search['email_lower'] = (fields['email'] or '').strip().lower()
+    if 'name' in fields:
+        search['name_lower'] = normalize_search_text(fields['name'] or '').strip()
+    if 'phone' in fields:
+        search['phone_digits'] = phone_search_digits(fields['phone'])
+    return search
+
+def user_search_query(search: str) -> Dict[str, Any]:
+    """Prefix match on email, name or phone; each branch is an index range scan"""
+    term = search.strip()
+    clauses = [
+        {"email_lower": {"$regex": "^" + re.escape(term.lower())}},
+        {"name_lower": {"$regex": "^" + re.escape(normalize_search_text(term))}},
+    ]
+    digits = phone_search_digits(term)
+    if len(digits) >= 3:
+        clauses.append({"phone_digits": {"$regex": "^" + digits}})
+    return {"$or": clauses}
+
+async def migrate_user_search_fields(batch_size: int = 500) -> int:
+    """Fill search keys on users created before they existed"""
+    query = {"email_lower": {"$exists": False}}
+    migrated = 0
+    while True:
+        users = await db.users.find(query, {"_id": 1, "email": 1, "name": 1, "phone": 1}).limit(batch_size).to_list(batch_size)
+        if not users:
+            break
+        await db.users.bulk_write([
+            UpdateOne({"_id": user['_id']}, {"$set": user_search_fields({
+                "email": user.get('email'), "name": user.get('name'), "phone": user.get('phone')
+            })})
+            for user in users
+        ], ordered=False)
+        migrated += len(users)
+    if migrated:
+        logging.info(f"Added search keys to {migrated} users")
+    return migrated
+
 @api_router.get("/admin/users")
-async def get_all_users(request: Request, response: Response):
-    """Get all users (admin only)"""
+async def get_all_users(
+    request: Request,
+    response: Response,
+    search: Optional[str] = None,
+    role: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE
+):
+    """Admin user directory, newest first. Next page cursor and total count are sent as headers."""
     await get_admin_user(request, response)
+    limit = page_limit(limit)
     
-    users = await db.users.find({}, {"password_hash": 0}).to_list(1000)
+    query: Dict[str, Any] = {}
+    if role:
+        query["role"] = role
+    if search and search.strip():
+        query.update(user_search_query(search))
+    
+    users = await db.users.find(apply_keyset(query, cursor, id_field="_id"), USER_LIST_PROJECTION).sort(
+        [("created_at", -1), ("_id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = encode_cursor(users[-1].get('created_at'), users[-1].get('_id'))
+    set_page_headers(response, next_cursor, await cached_count(db.users, query))
     
     for user in users:
-        # Get user_id first
-        user_id = user.get("id") or str(user.get("_id", ""))
-        
-        # Convert ObjectId to string and remove _id
-        if "_id" in user:
-            user.pop("_id")
-        
-        # Set id
-        user["id"] = user_id
-        
-        # Convert datetime
-        if isinstance(user.get('created_at'), str):
-            user['created_at'] = datetime.fromisoformat(user['created_at'])
-        elif user.get('created_at'):
-            user['created_at'] = user['created_at'].isoformat() if hasattr(user['created_at'], 'isoformat') else str(user['created_at'])
-        
-        # Ensure all required fields exist
-        user.setdefault('email', '')
-        user.setdefault('name', '')
+        user_id = user.pop('_id', None)
+        user['id'] = user.get('id') or str(user_id)
         user.setdefault('role', 'user')
-        user.setdefault('phone', '')
-        user.setdefault('address', '')
-        user.setdefault('city', '')
-        user.setdefault('postal_code', '')
-    
     return users
 
 @api_router.put("/admin/users/{user_id}/role")
@@ -1378,13 +3523,16 @@ async def update_user_role(user_id: str, role_data: Dict[str, str], request: Req
     if new_role not in ['user', 'admin']:
         raise HTTPException(status_code=400, detail="Invalid role")
     
-    result = await db.users.update_one(
+    previous = await db.users.find_one_and_update(
         {"$or": [{"id": user_id}, {"_id": user_id}]},
-        {"$set": {"role": new_role}}
+        {"$set": {"role": new_role}},
+        projection={"_id": 0, "role": 1}
     )
     
-    if result.matched_count == 0:
+    if previous is None:
         raise HTTPException(status_code=404, detail="User not found")
+    if (previous.get('role') == 'user') != (new_role == 'user'):
+        await bump_dashboard_stats({"total_users": 1 if new_role == 'user' else -1})
     
     return {"message": f"User role updated to {new_role}"}
 
@@ -1396,6 +3544,7 @@ async def admin_update_user_profile(user_id: str, profile_data: Dict[str, Any],
     # Remove sensitive fields
     profile_data.pop('password_hash', None)
     profile_data.pop('role', None)
+    profile_data.update(user_search_fields(profile_data))
     
     result = await db.users.update_one(
         {"$or": [{"id": user_id}, {"_id": user_id}]},
@@ -1412,10 +3561,15 @@ async def delete_user(user_id: str, request: Request, response: Response):
     """Delete user (admin only)"""
     await get_admin_user(request, response)
     
-    result = await db.users.delete_one({"$or": [{"id": user_id}, {"_id": user_id}]})
+    deleted = await db.users.find_one_and_delete(
+        {"$or": [{"id": user_id}, {"_id": user_id}]},
+        projection={"_id": 0, "role": 1}
+    )
     
-    if result.deleted_count == 0:
+    if deleted is None:
         raise HTTPException(status_code=404, detail="User not found")
+    if deleted.get('role') == 'user':
+        await bump_dashboard_stats({"total_users": -1})
     
     # Delete user's sessions
     await db.user_sessions.delete_many({"user_id": user_id})
@@ -1450,32 +3604,814 @@ async def get_user_orders(user_id: str, request: Request, response: Response):
     await get_admin_user(request, response)
     
     # Fetch orders for this user
-    orders = await db.orders.find({"user_id": user_id}).sort("created_at", -1).to_list(100)
+    orders = await find_orders_newest_first({"user_id": user_id}, {"_id": 0}, 100)
     
     for order in orders:
         if "_id" in order:
             order.pop("_id")
+        expand_order_timeline(order)
         if isinstance(order.get('created_at'), str):
             order['created_at'] = datetime.fromisoformat(order['created_at'])
     
     return orders
 
+USER_DETAIL_PROJECTION = {
+    "password_hash": 0, "favorites": 0, "saved_cards": 0,
+    **{field: 0 for field in USER_SEARCH_SOURCES}
+}
+USER_DETAIL_RECENT = 20
+
+@api_router.get("/admin/users/{user_id}/detail")
+async def get_user_detail(user_id: str, request: Request, response: Response):
+    """Profile, cards, recent orders and payments, and active session count in one call (admin only)"""
+    await get_admin_user(request, response)
+    
+    user = await db.users.find_one({"$or": [{"id": user_id}, {"_id": user_id}]}, USER_DETAIL_PROJECTION)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    user['id'] = user_id = user.get('id') or str(user.pop('_id'))
+    user.pop('_id', None)
+    user.setdefault('role', 'user')
+    
+    # Guest and older checkouts only carry customer_email, so match either key
+    order_query: Dict[str, Any] = {"user_id": user_id}
+    if user.get('email'):
+        order_query = {"$or": [order_query, {"customer_email": user['email']}]}
+    cards, orders, payments, active_sessions = await asyncio.gather(
+        db.user_cards.find({"user_id": user_id}, {"_id": 0}).to_list(100),
+        find_orders_newest_first(order_query, ORDER_SUMMARY_PROJECTION, USER_DETAIL_RECENT),
+        db.payment_transactions.find({"user_id": user_id}, PAYMENT_LIST_PROJECTION).sort(
+            [("created_at", -1), ("id", -1)]
+        ).limit(USER_DETAIL_RECENT).to_list(USER_DETAIL_RECENT),
+        db.user_sessions.count_documents({"user_id": user_id, "expires_at": {"$gt": datetime.now(timezone.utc).isoformat()}})
+    )
+    return {
+        "user": user,
+        "cards": cards,
+        "recent_orders": orders,
+        "recent_payments": payments,
+        "active_sessions": active_sessions
+    }
+
+
+PAYMENT_LIST_PROJECTION = {"_id": 0, "cart_items": 0, "metadata": 0}
+
+_payment_summary_cache: TTLCache = TTLCache(maxsize=256, ttl=COUNT_CACHE_TTL)
+
+def payment_ledger_query(
+    payment_status: Optional[str] = None,
+    method: Optional[str] = None,
+    user: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None
+) -> Dict[str, Any]:
+    query: Dict[str, Any] = {}
+    if payment_status:
+        query["payment_status"] = payment_status
+    if method:
+        # Stripe transactions from before payment_method was stored have none
+        query["payment_method"] = {"$in": ["stripe", None]} if method == "stripe" else method
+    if user:
+        user = user.strip()
+        query["user_email" if "@" in user else "user_id"] = user
+    created_range = date_range_filter(date_from, date_to)
+    if created_range:
+        query["created_at"] = created_range
+    if min_amount is not None or max_amount is not None:
+        query["amount"] = {}
+        if min_amount is not None:
+            query["amount"]["$gte"] = min_amount
+        if max_amount is not None:
+            query["amount"]["$lte"] = max_amount
+    return query
+
+async def payment_ledger_summary(query: Dict[str, Any]) -> Dict[str, Any]:
+    """Count and amount per status and currency for a ledger filter, cached briefly"""
+    key = json.dumps(query, sort_keys=True, default=str)
+    if key in _payment_summary_cache:
+        return _payment_summary_cache[key]
+    rows = await db.payment_transactions.aggregate([
+        {"$match": query},
+        {"$group": {
+            "_id": {"status": "$payment_status", "currency": "$currency"},
+            "count": {"$sum": 1},
+            "amount": {"$sum": "$amount"}
+        }},
+        {"$sort": {"_id.status": 1, "_id.currency": 1}}
+    ]).to_list(None)
+    summary = {
+        "count": sum(row['count'] for row in rows),
+        "by_status": [
+            {
+                "payment_status": row['_id'].get('status'),
+                "currency": row['_id'].get('currency'),
+                "count": row['count'],
+                "amount": round(row['amount'] or 0, 2)
+            }
+            for row in rows
+        ]
+    }
+    _payment_summary_cache[key] = summary
+    return summary
 
 @api_router.get("/admin/payments")
-async def get_all_payments(request: Request, response: Response):
-    """Get all payment transactions (admin only)"""
+async def get_all_payments(
+    request: Request,
+    response: Response,
+    payment_status: Optional[str] = Query(None, alias="status"),
+    method: Optional[str] = None,
+    user: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE
+):
+    """Payment ledger, newest first. Next page cursor and total count are sent as headers."""
     await get_admin_user(request, response)
+    limit = page_limit(limit)
+    query = payment_ledger_query(payment_status, method, user, date_from, date_to, min_amount, max_amount)
     
-    payments = await db.payment_transactions.find({}).sort("created_at", -1).to_list(1000)
+    payments = await db.payment_transactions.find(apply_keyset(query, cursor), PAYMENT_LIST_PROJECTION).sort(
+        [("created_at", -1), ("id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    next_cursor = None
+    if len(payments) > limit:
+        payments = payments[:limit]
+        next_cursor = encode_cursor(payments[-1].get('created_at'), payments[-1].get('id'))
+    set_page_headers(response, next_cursor, await cached_count(db.payment_transactions, query))
     
     for payment in payments:
-        if "_id" in payment:
-            payment.pop("_id")
         if isinstance(payment.get('created_at'), str):
             payment['created_at'] = datetime.fromisoformat(payment['created_at'])
     
     return payments
 
+@api_router.get("/admin/payments/summary")
+async def get_payments_summary(
+    request: Request,
+    response: Response,
+    payment_status: Optional[str] = Query(None, alias="status"),
+    method: Optional[str] = None,
+    user: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None
+):
+    """Totals for the same filters as /admin/payments (admin only)"""
+    await get_admin_user(request, response)
+    query = payment_ledger_query(payment_status, method, user, date_from, date_to, min_amount, max_amount)
+    return await payment_ledger_summary(query)
+
+
+# ============= REFERRALS =============
+
+# referrals: one edge per referred user (_id = referred user id), carrying
+# that user's paid-order conversion. referral_stats: one document per
+# referrer (_id = referrer id) with running totals for the leaderboard.
+REFERRAL_BONUS = 10.0
+REFERRAL_LEADERBOARD_SORTS = {"signups": "signups", "converted": "converted", "revenue": "revenue"}
+
+def referral_edge(referrer: Dict[str, Any], user: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "_id": user.get('id') or user.get('_id'),
+        "referrer_id": referrer.get('id') or referrer.get('_id'),
+        "referred_email": user.get('email'),
+        "referred_name": user.get('name'),
+        "referral_code": referrer.get('referral_code'),
+        "created_at": user.get('created_at'),
+        "paid_orders": 0,
+        "revenue": 0.0,
+        "first_order_at": None
+    }
+
+def referrer_profile(referrer: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "referrer_email": referrer.get('email'),
+        "referrer_name": referrer.get('name'),
+        "referral_code": referrer.get('referral_code')
+    }
+
+async def record_referral(referrer: Dict[str, Any], user: Dict[str, Any]):
+    """Store the edge for a new sign-up and count it for the referrer"""
+    edge = referral_edge(referrer, user)
+    try:
+        await db.referrals.insert_one(edge)
+        await db.referral_stats.update_one(
+            {"_id": edge['referrer_id']},
+            {"$inc": {"signups": 1, "bonus": REFERRAL_BONUS}, "$set": referrer_profile(referrer)},
+            upsert=True
+        )
+    except Exception as e:
+        logging.error(f"Referral tracking failed for {edge['referred_email']}: {e}")
+
+async def record_referral_conversion(before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]):
+    """Count a referred customer's paid orders and revenue; the first one converts them"""
+    was_sale, is_sale = is_counted_sale(before), is_counted_sale(after)
+    if was_sale == is_sale:
+        return
+    order = after if is_sale else before
+    if not order.get('customer_email'):
+        return
+    sign = 1 if is_sale else -1
+    revenue = sign * (order.get('total') or 0)
+    try:
+        edge = await db.referrals.find_one_and_update(
+            {"referred_email": order['customer_email']},
+            {"$inc": {"paid_orders": sign, "revenue": revenue}},
+            projection={"referrer_id": 1, "paid_orders": 1, "first_order_at": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not edge:
+            return
+        inc = {"revenue": revenue, "paid_orders": sign}
+        if sign > 0 and edge['paid_orders'] == 1:
+            inc["converted"] = 1
+            if not edge.get('first_order_at'):
+                await db.referrals.update_one({"_id": edge['_id']}, {"$set": {"first_order_at": order.get('created_at')}})
+        elif sign < 0 and edge['paid_orders'] == 0:
+            inc["converted"] = -1
+        await db.referral_stats.update_one({"_id": edge['referrer_id']}, {"$inc": inc}, upsert=True)
+    except Exception as e:
+        logging.error(f"Referral conversion update failed for order {order.get('id')}: {e}")
+
+async def rebuild_referrals(batch_size: int = 1000) -> Dict[str, Any]:
+    """Rebuild referral edges and referrer totals from users.referred_by and paid orders"""
+    stamp = datetime.now(timezone.utc).isoformat()
+    referrers: Dict[str, Optional[Dict[str, Any]]] = {}  # referral code -> referrer (None if unknown)
+    edges = 0
+    cursor = db.users.find(
+        {"referred_by": {"$nin": [None, ""]}},
+        {"_id": 1, "id": 1, "email": 1, "name": 1, "created_at": 1, "referred_by": 1},
+        batch_size=batch_size
+    )
+    batch = []
+    async for user in cursor:
+        batch.append(user)
+        if len(batch) < batch_size:
+            continue
+        edges += await _rebuild_referral_batch(batch, referrers, stamp)
+        batch = []
+    if batch:
+        edges += await _rebuild_referral_batch(batch, referrers, stamp)
+    await db.referrals.delete_many({"rebuilt_at": {"$ne": stamp}})
+    
+    totals = await db.referrals.aggregate([
+        {"$group": {
+            "_id": "$referrer_id",
+            "signups": {"$sum": 1},
+            "converted": {"$sum": {"$cond": [{"$gt": ["$paid_orders", 0]}, 1, 0]}},
+            "paid_orders": {"$sum": "$paid_orders"},
+            "revenue": {"$sum": "$revenue"}
+        }}
+    ], allowDiskUse=True).to_list(None)
+    profiles = {referrer.get('id') or referrer.get('_id'): referrer for referrer in referrers.values() if referrer}
+    ops = [
+        ReplaceOne(
+            {"_id": row['_id']},
+            {**{k: v for k, v in row.items() if k != '_id'}, "bonus": row['signups'] * REFERRAL_BONUS,
+             **referrer_profile(profiles.get(row['_id'], {})), "rebuilt_at": stamp},
+            upsert=True
+        )
+        for row in totals
+    ]
+    for i in range(0, len(ops), 1000):
+        await db.referral_stats.bulk_write(ops[i:i + 1000], ordered=False)
+    await db.referral_stats.delete_many({"rebuilt_at": {"$ne": stamp}})
+    return {"edges": edges, "referrers": len(ops)}
+
+async def _rebuild_referral_batch(users: List[Dict[str, Any]], referrers: Dict[str, Any], stamp: str) -> int:
+    codes = {user['referred_by'] for user in users} - set(referrers)
+    if codes:
+        async for referrer in db.users.find(
+            {"referral_code": {"$in": list(codes)}},
+            {"_id": 1, "id": 1, "email": 1, "name": 1, "referral_code": 1}
+        ):
+            referrers[referrer['referral_code']] = referrer
+        for code in codes:
+            referrers.setdefault(code, None)
+    
+    linked = [(referrers[user['referred_by']], user) for user in users if referrers.get(user['referred_by'])]
+    emails = [user.get('email') for _, user in linked if user.get('email')]
+    conversions = {}
+    if emails:
+        sale_match = {"customer_email": {"$in": emails}, "payment_status": "paid", "status": {"$ne": "cancelled"}}
+        sale_fields = {"$project": {"_id": 0, "customer_email": 1, "total": 1, "created_at": 1}}
+        async for row in db.orders.aggregate([
+            {"$match": sale_match},
+            sale_fields,
+            {"$unionWith": {"coll": "orders_archive", "pipeline": [{"$match": sale_match}, sale_fields]}},
+            {"$group": {
+                "_id": "$customer_email",
+                "paid_orders": {"$sum": 1},
+                "revenue": {"$sum": "$total"},
+                "first_order_at": {"$min": "$created_at"}
+            }}
+        ]):
+            conversions[row.pop('_id')] = row
+    
+    ops = []
+    for referrer, user in linked:
+        edge = {**referral_edge(referrer, user), **conversions.get(user.get('email'), {}), "rebuilt_at": stamp}
+        ops.append(ReplaceOne({"_id": edge['_id']}, edge, upsert=True))
+    if ops:
+        await db.referrals.bulk_write(ops, ordered=False)
+    return len(ops)
+
+def referral_stats_row(stats: Dict[str, Any]) -> Dict[str, Any]:
+    stats['referrer_id'] = stats.pop('_id')
+    stats.pop('rebuilt_at', None)
+    signups = stats.get('signups') or 0
+    stats['revenue'] = round(stats.get('revenue') or 0, 2)
+    stats['conversion_rate'] = round((stats.get('converted') or 0) / signups, 4) if signups else 0.0
+    return stats
+
+@api_router.get("/admin/referrals/leaderboard")
+async def get_referral_leaderboard(
+    request: Request,
+    response: Response,
+    by: str = Query("signups", pattern="^(signups|converted|revenue)$"),
+    limit: int = 20
+):
+    """Top referrers by sign-ups, converted customers or referred revenue (admin only)"""
+    await get_admin_user(request, response)
+    limit = max(1, min(limit, 100))
+    rows = await db.referral_stats.find({}).sort(REFERRAL_LEADERBOARD_SORTS[by], -1).limit(limit).to_list(limit)
+    return [referral_stats_row(row) for row in rows]
+
+@api_router.get("/admin/referrals/{referrer_id}")
+async def get_referrer_referrals(
+    referrer_id: str,
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = 50
+):
+    """A referrer's totals and the users they referred, newest first (admin only)"""
+    await get_admin_user(request, response)
+    limit = page_limit(limit)
+    stats, edges = await asyncio.gather(
+        db.referral_stats.find_one({"_id": referrer_id}),
+        db.referrals.find(apply_keyset({"referrer_id": referrer_id}, cursor, id_field="_id")).sort(
+            [("created_at", -1), ("_id", -1)]
+        ).limit(limit + 1).to_list(limit + 1)
+    )
+    next_cursor = None
+    if len(edges) > limit:
+        edges = edges[:limit]
+        next_cursor = encode_cursor(edges[-1].get('created_at'), edges[-1].get('_id'))
+    set_page_headers(response, next_cursor, (stats or {}).get('signups') or 0)
+    for edge in edges:
+        edge['referred_id'] = edge.pop('_id')
+        edge.pop('rebuilt_at', None)
+    return {
+        "stats": referral_stats_row(stats) if stats else None,
+        "referrals": edges
+    }
+
+@api_router.post("/admin/referrals/rebuild")
+async def run_referral_rebuild(request: Request, response: Response):
+    """Rebuild the referral graph and leaderboard from users and orders (admin only)"""
+    await get_admin_user(request, response)
+    return await rebuild_referrals()
+
+# ============= BULK ADMIN OPERATIONS =============
+
+BULK_MAX_IDS = int(os.environ.get('BULK_MAX_IDS', 5000))
+BULK_CHUNK_SIZE = 500
+BULK_ORDER_OPERATIONS = ["set_status", "set_payment_status", "cancel"]
+BULK_USER_OPERATIONS = ["set_role"]
+BULK_PRODUCT_OPERATIONS = ["activate", "deactivate"]
+PAYMENT_STATUSES = ["pending", "paid", "failed"]
+
+def bulk_ids(body: BulkAdminRequest, operations: List[str]) -> List[str]:
+    if body.operation not in operations:
+        raise HTTPException(status_code=400, detail=f"Invalid operation. Allowed: {', '.join(operations)}")
+    ids = list(dict.fromkeys(item_id for item_id in body.ids if item_id))
+    if not ids:
+        raise HTTPException(status_code=400, detail="No ids given")
+    if len(ids) > BULK_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_IDS} ids per request")
+    return ids
+
+async def apply_bulk_update(collection, ids: List[str], id_fields: List[str], projection: Dict[str, Any], plan) -> tuple:
+    """Look up each chunk of ids, $set plan(doc) on the ones that need it with one unordered bulk_write.
+
+    plan returns the fields to set, None when the document is already in the
+    target state, or a string explaining why it was skipped. Each write is
+    guarded on the values plan read for the fields it sets and tags the
+    document with a per-chunk token (as reserve_stock does), so a document
+    changed by someone else in between is reported as a conflict instead of
+    being counted twice. Returns the per-id results and the (before, after)
+    pairs that were written.
+    """
+    results: Dict[str, Dict[str, Any]] = {}
+    changed = []
+    for i in range(0, len(ids), BULK_CHUNK_SIZE):
+        chunk = ids[i:i + BULK_CHUNK_SIZE]
+        wanted = set(chunk)
+        docs = {}
+        lookup = {"$or": [{field: {"$in": chunk}} for field in id_fields]}
+        for doc in await collection.find(lookup, {**projection, "_id": 1}).to_list(None):
+            for field in id_fields:
+                if doc.get(field) in wanted:
+                    docs.setdefault(doc[field], doc)
+        
+        token = str(uuid.uuid4())
+        ops, pending = [], []
+        for item_id in chunk:
+            doc = docs.get(item_id)
+            if doc is None:
+                results[item_id] = {"id": item_id, "result": "not_found"}
+                continue
+            update = plan(doc)
+            if update is None:
+                results[item_id] = {"id": item_id, "result": "unchanged"}
+            elif isinstance(update, str):
+                results[item_id] = {"id": item_id, "result": "skipped", "error": update}
+            else:
+                guard = {field: doc.get(field) for field in update if projection.get(field)}
+                ops.append(UpdateOne(
+                    {"_id": doc['_id'], **guard},
+                    {"$set": update, "$push": {"bulk_holds": token}}
+                ))
+                pending.append((item_id, doc, update))
+        if not ops:
+            continue
+        
+        failed: Dict[int, str] = {}
+        try:
+            result = await collection.bulk_write(ops, ordered=False)
+            written = result.modified_count
+        except BulkWriteError as e:
+            failed = {err['index']: err.get('errmsg', 'write failed') for err in e.details.get('writeErrors', [])}
+            written = e.details.get('nModified', 0)
+        
+        applied = set()
+        if written:
+            applied = {
+                doc['_id'] for doc in await collection.find(
+                    {"_id": {"$in": [doc['_id'] for _, doc, _ in pending]}, "bulk_holds": token}, {"_id": 1}
+                ).to_list(None)
+            }
+            # Drop the token, and the field once no other bulk operation holds it
+            remaining = {"$filter": {"input": "$bulk_holds", "cond": {"$ne": ["$$this", token]}}}
+            await collection.update_many({"_id": {"$in": list(applied)}}, [{"$set": {"bulk_holds": {
+                "$cond": [{"$eq": [{"$size": remaining}, 0]}, "$$REMOVE", remaining]
+            }}}])
+        for index, (item_id, doc, update) in enumerate(pending):
+            if index in failed:
+                results[item_id] = {"id": item_id, "result": "failed", "error": failed[index]}
+            elif doc['_id'] not in applied:
+                results[item_id] = {"id": item_id, "result": "conflict", "error": "Changed by another request, retry"}
+            else:
+                results[item_id] = {"id": item_id, "result": "updated"}
+                doc.pop('_id', None)
+                changed.append((doc, {**doc, **update}))
+    
+    outcomes = [results[item_id] for item_id in ids]
+    return outcomes, changed
+
+def bulk_response(operation: str, outcomes: List[Dict[str, Any]]) -> Dict[str, Any]:
+    counts = Counter(outcome['result'] for outcome in outcomes)
+    return {
+        "operation": operation,
+        "requested": len(outcomes),
+        **{result: counts.get(result, 0) for result in ("updated", "unchanged", "skipped", "conflict", "not_found", "failed")},
+        "results": outcomes
+    }
+
+@api_router.post("/admin/orders/bulk")
+async def bulk_update_orders(body: BulkAdminRequest, request: Request, response: Response):
+    """Set status or payment status of, or cancel, many orders at once (admin only)"""
+    admin = await get_admin_user(request, response)
+    ids = bulk_ids(body, BULK_ORDER_OPERATIONS)
+    now = datetime.now(timezone.utc).isoformat()
+    
+    if body.operation == "set_status":
+        if not body.value:
+            raise HTTPException(status_code=400, detail="value (new status) required")
+        if body.value == "cancelled":
+            raise HTTPException(status_code=400, detail="Use the cancel operation to cancel orders")
+        plan = lambda order: None if order.get('status') == body.value else {"status": body.value, "updated_at": now}
+    elif body.operation == "set_payment_status":
+        if body.value not in PAYMENT_STATUSES:
+            raise HTTPException(status_code=400, detail=f"value must be one of: {', '.join(PAYMENT_STATUSES)}")
+        plan = lambda order: None if order.get('payment_status') == body.value else {"payment_status": body.value, "updated_at": now}
+    else:
+        if not body.reason:
+            raise HTTPException(status_code=400, detail="Cancellation reason required")
+        cancellation = {
+            "status": "cancelled",
+            "cancellation_reason": body.reason,
+            "cancelled_by": admin['email'],
+            "cancelled_at": now,
+            "updated_at": now
+        }
+        plan = lambda order: None if order.get('status') == 'cancelled' else cancellation
+    
+    outcomes, changed = await apply_bulk_update(db.orders, ids, ["id"], ORDER_CHANGE_FIELDS, plan)
+    if changed:
+        await record_order_changes(changed)
+        for _, order in changed:
+            invalidate_tracking_cache(order['id'])
+        admin_stats_cache.invalidate()
+    return bulk_response(body.operation, outcomes)
+
+@api_router.post("/admin/users/bulk")
+async def bulk_update_users(body: BulkAdminRequest, request: Request, response: Response):
+    """Change the role of many users at once (admin only)"""
+    admin = await get_admin_user(request, response)
+    ids = bulk_ids(body, BULK_USER_OPERATIONS)
+    if body.value not in ['user', 'admin']:
+        raise HTTPException(status_code=400, detail="Invalid role")
+    admin_id = admin.get('id') or admin.get('_id')
+    
+    def plan(user):
+        if (user.get('id') or user.get('_id')) == admin_id:
+            return "Cannot change your own role"
+        return None if user.get('role') == body.value else {"role": body.value}
+    
+    outcomes, changed = await apply_bulk_update(db.users, ids, ["_id", "id"], {"id": 1, "role": 1}, plan)
+    delta = sum(
+        (after.get('role') == 'user') - (before.get('role') == 'user')
+        for before, after in changed
+    )
+    if delta:
+        await bump_dashboard_stats({"total_users": delta})
+        admin_stats_cache.invalidate()
+    return bulk_response(body.operation, outcomes)
+
+@api_router.post("/admin/products/bulk")
+async def bulk_update_products(body: BulkAdminRequest, request: Request, response: Response):
+    """Activate or deactivate many products at once (admin only)"""
+    await get_admin_user(request, response)
+    ids = bulk_ids(body, BULK_PRODUCT_OPERATIONS)
+    active = body.operation == "activate"
+    plan = lambda product: None if bool(product.get('is_active')) == active else {"is_active": active}
+    
+    outcomes, changed = await apply_bulk_update(
+        db.products, ids, ["id"],
+        {"id": 1, "is_active": 1, "category_id": 1, "title": 1, "brand": 1, "description": 1, "price": 1},
+        plan
+    )
+    if changed:
+        await bump_dashboard_stats({"total_products": len(changed) if active else -len(changed)})
+        await refresh_category_stats(*{product.get('category_id') for _, product in changed})
+        for _, product in changed:
+            index_product_for_search(product)
+        admin_stats_cache.invalidate()
+    return bulk_response(body.operation, outcomes)
+
+# ============= ADMIN EXPORTS =============
+
+ORDER_EXPORT_COLUMNS = [
+    "id", "tracking_number", "created_at", "customer_name", "customer_email", "customer_phone",
+    "delivery_address", "status", "payment_status", "payment_method", "subtotal", "discount",
+    "coupon_code", "total", "item_count", "cancellation_reason", "cancelled_at"
+]
+PAYMENT_EXPORT_COLUMNS = [
+    "id", "created_at", "order_id", "session_id", "user_id", "user_email", "amount", "currency",
+    "payment_method", "payment_status", "from_card_last4", "to_card_last4"
+]
+EXPORT_FLUSH_ROWS = 500  # rows buffered before a chunk is sent
+XLSX_SHEET_ROWS = 1_000_000  # Excel allows 1,048,576 rows per sheet
+_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+_XLSX_ILLEGAL_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def parse_export_columns(columns: Optional[str], allowed: List[str]) -> List[str]:
+    if not columns:
+        return allowed
+    selected = [c.strip() for c in columns.split(',') if c.strip()]
+    unknown = [c for c in selected if c not in allowed]
+    if unknown or not selected:
+        raise HTTPException(status_code=400, detail=f"Unknown columns: {', '.join(unknown)}. Allowed: {', '.join(allowed)}")
+    return selected
+
+def export_projection(columns: List[str]) -> Dict[str, Any]:
+    projection: Dict[str, Any] = {"_id": 0}
+    for column in columns:
+        if column == "item_count":
+            projection["item_count"] = {"$size": {"$ifNull": ["$items", []]}}
+        else:
+            projection[column] = 1
+    return projection
+
+def _export_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str, ensure_ascii=False)
+    if isinstance(value, str) and value.startswith(_FORMULA_PREFIXES):
+        # Customer-typed text must not run as a formula when the file is opened in Excel
+        return "'" + value
+    return value
+
+async def stream_csv(cursor, columns: List[str]):
+    """CSV chunks straight from a Motor cursor; the header goes out before the first row is read"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield ("\ufeff" + buffer.getvalue()).encode()  # BOM so Excel reads UTF-8
+    buffer.seek(0)
+    buffer.truncate(0)
+    rows = 0
+    async for doc in cursor:
+        writer.writerow([_export_value(doc.get(column)) for column in columns])
+        rows += 1
+        if rows % EXPORT_FLUSH_ROWS == 0:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+class _ChunkSink(io.RawIOBase):
+    """Unseekable file object collecting zip output until it is drained"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def _xlsx_cell(value) -> str:
+    value = _export_value(value)
+    if isinstance(value, bool):
+        value = str(value).lower()
+    if isinstance(value, (int, float)):
+        return f'<c><v>{value}</v></c>'
+    text = xml_escape(_XLSX_ILLEGAL_CHARS.sub("", str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+def _xlsx_row(values) -> str:
+    return "<row>" + "".join(_xlsx_cell(v) for v in values) + "</row>"
+
+async def stream_xlsx(cursor, columns: List[str], sheet_name: str):
+    """XLSX written through a streaming zip.
+
+    Sheet XML is deflated as rows arrive and drained every EXPORT_FLUSH_ROWS
+    rows. Past XLSX_SHEET_ROWS rows a new sheet is started; the workbook
+    parts listing the sheets are written last.
+    """
+    sink = _ChunkSink()
+    archive = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED)
+    header = _xlsx_row(columns)
+    sheets = 0
+    sheet = None
+    rows_in_sheet = 0
+
+    def open_sheet():
+        nonlocal sheets, sheet, rows_in_sheet
+        sheets += 1
+        rows_in_sheet = 0
+        sheet = archive.open(f"xl/worksheets/sheet{sheets}.xml", mode="w", force_zip64=True)
+        sheet.write((
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            + header
+        ).encode())
+
+    def close_sheet():
+        sheet.write(b"</sheetData></worksheet>")
+        sheet.close()
+
+    open_sheet()
+    yield sink.drain()
+    async for doc in cursor:
+        if rows_in_sheet >= XLSX_SHEET_ROWS:
+            close_sheet()
+            open_sheet()
+        sheet.write(_xlsx_row(doc.get(column) for column in columns).encode())
+        rows_in_sheet += 1
+        if rows_in_sheet % EXPORT_FLUSH_ROWS == 0:
+            yield sink.drain()
+    close_sheet()
+
+    sheet_ids = range(1, sheets + 1)
+    archive.writestr("[Content_Types].xml", (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        + "".join(
+            f'<Override PartName="/xl/worksheets/sheet{i}.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            for i in sheet_ids
+        )
+        + '</Types>'
+    ))
+    archive.writestr("_rels/.rels", (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ))
+    archive.writestr("xl/workbook.xml", (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>'
+        + "".join(
+            f'<sheet name="{sheet_name}{"" if i == 1 else f" {i}"}" sheetId="{i}" r:id="rId{i}"/>'
+            for i in sheet_ids
+        )
+        + '</sheets></workbook>'
+    ))
+    archive.writestr("xl/_rels/workbook.xml.rels", (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        + "".join(
+            f'<Relationship Id="rId{i}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet{i}.xml"/>'
+            for i in sheet_ids
+        )
+        + '</Relationships>'
+    ))
+    archive.close()
+    yield sink.drain()
+
+def export_response(cursor, columns: List[str], export_format: str, name: str) -> StreamingResponse:
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')
+    if export_format == "xlsx":
+        body = stream_xlsx(cursor, columns, sheet_name=name.capitalize())
+        media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    else:
+        body = stream_csv(cursor, columns)
+        media_type = "text/csv; charset=utf-8"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{name}_{stamp}.{export_format}"'}
+    )
+
+@api_router.get("/admin/export/orders")
+async def export_orders(
+    request: Request,
+    response: Response,
+    export_format: str = Query("csv", alias="format", pattern="^(csv|xlsx)$"),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    order_status: Optional[str] = Query(None, alias="status"),
+    columns: Optional[str] = None
+):
+    """Stream orders as CSV/XLSX for accounting (admin only)"""
+    await get_admin_user(request, response)
+    selected = parse_export_columns(columns, ORDER_EXPORT_COLUMNS)
+    
+    query: Dict[str, Any] = {}
+    if order_status:
+        query["status"] = order_status
+    created_range = date_range_filter(date_from, date_to)
+    if created_range:
+        query["created_at"] = created_range
+    
+    projection = export_projection(selected)
+    
+    async def rows():
+        # Archived orders first, each tier in created_at order
+        for collection in (db.orders_archive, db.orders):
+            async for order in collection.find(query, projection, batch_size=1000).sort("created_at", 1):
+                yield order
+    
+    return export_response(rows(), selected, export_format, "orders")
+
+@api_router.get("/admin/export/payments")
+async def export_payments(
+    request: Request,
+    response: Response,
+    export_format: str = Query("csv", alias="format", pattern="^(csv|xlsx)$"),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    payment_status: Optional[str] = Query(None, alias="status"),
+    columns: Optional[str] = None
+):
+    """Stream payment transactions as CSV/XLSX for accounting (admin only)"""
+    await get_admin_user(request, response)
+    selected = parse_export_columns(columns, PAYMENT_EXPORT_COLUMNS)
+    
+    query: Dict[str, Any] = {}
+    if payment_status:
+        query["payment_status"] = payment_status
+    created_range = date_range_filter(date_from, date_to)
+    if created_range:
+        query["created_at"] = created_range
+    
+    cursor = db.payment_transactions.find(query, export_projection(selected), batch_size=1000).sort("created_at", 1)
+    return export_response(cursor, selected, export_format, "payments")
 
 @api_router.post("/admin/upload-image")
 async def upload_product_image(request: Request, response: Response, file: UploadFile = File(...)):
@@ -1532,6 +4468,8 @@ async def create_checkout_session(checkout_req: CreateCheckoutRequest, request:
             # Use server-side price (prevent manipulation)
             real_price = float(product['price'])
             quantity = int(item.get('quantity', 1))
+            if quantity < 1:
+                raise HTTPException(status_code=400, detail=f"Invalid quantity for product {item['product_id']}")
             total_amount += real_price * quantity
         
         # Initialize Stripe
@@ -1649,8 +4587,8 @@ async def get_checkout_status(session_id: str, request: Request):
             
             # Create order
             order = Order(
-                id=generate_short_id(),
-                tracking_number=f"ATB{generate_short_id()}",
+                id=generate_order_id(),
+                tracking_number=generate_tracking_number(),
                 customer_name=user['name'] if user else "Guest",
                 customer_email=user['email'] if user else transaction.get('user_email', ''),
                 customer_phone="",
@@ -1661,39 +4599,22 @@ async def get_checkout_status(session_id: str, request: Request):
                 payment_status="paid"
             )
             
-            # Calculate delivery dates
-            now = datetime.now(timezone.utc)
-            warehouse_date = now + timedelta(days=7)
-            airplane_date = warehouse_date + timedelta(days=5)
-            atabuy_date = airplane_date + timedelta(days=4)
-            delivery_date = atabuy_date + timedelta(days=4)
-            
-            order_doc = order.model_dump()
+            order_doc = compact_order_doc(order.model_dump())
             order_doc['created_at'] = order_doc['created_at'].isoformat()
             order_doc['updated_at'] = order_doc['updated_at'].isoformat()
-            order_doc['warehouse_date'] = warehouse_date.isoformat()
-            order_doc['airplane_date'] = airplane_date.isoformat()
-            order_doc['atabuy_date'] = atabuy_date.isoformat()
-            order_doc['delivery_date'] = delivery_date.isoformat()
-            
-            order_doc['status_history'] = [
-                {"status": "confirmed", "date": now.isoformat(), "message": "Sifarişiniz təsdiqləndi"},
-                {"status": "warehouse", "date": warehouse_date.isoformat(), "message": "Anbardan çıxdı"},
-                {"status": "airplane", "date": airplane_date.isoformat(), "message": "Təyyarəyə verildi"},
-                {"status": "atabuy_warehouse", "date": atabuy_date.isoformat(), "message": "AtaBuy anbarına gətirildi"},
-                {"status": "delivered", "date": delivery_date.isoformat(), "message": "Ünvana çatdırıldı"}
-            ]
-            
-            await db.orders.insert_one(order_doc)
             
-            # Update stock
-            for item in order_items:
-                await db.products.update_one(
-                    {"id": item['product_id']},
-                    {"$inc": {"stock": -item['quantity']}}
+            try:
+                await place_order(order_doc, order_items)
+            except OutOfStockError as e:
+                # Payment went through, keep it visible for a refund
+                update_data['order_error'] = "out_of_stock"
+                await db.payment_transactions.update_one(
+                    {"session_id": session_id},
+                    {"$set": update_data}
                 )
+                raise out_of_stock_exception(e)
             
-            update_data['order_id'] = order.id
+            update_data['order_id'] = order_doc['id']
         
         # Update transaction in database
         await db.payment_transactions.update_one(
@@ -1709,6 +4630,8 @@ async def get_checkout_status(session_id: str, request: Request):
             "order_id": update_data.get('order_id')
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Status check error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1756,6 +4679,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count"],
 )
 
 logging.basicConfig(
@@ -1764,6 +4688,24 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+_background_tasks: List[asyncio.Task] = []
+
+@app.on_event("startup")
+async def startup_tasks():
+    await ensure_indexes()
+    _background_tasks.append(asyncio.create_task(rebuild_search_index()))
+    _background_tasks.append(asyncio.create_task(migrate_user_search_fields()))
+    _background_tasks.append(asyncio.create_task(run_product_counter_flusher()))
+    _background_tasks.append(asyncio.create_task(run_order_scheduler()))
+    _background_tasks.append(asyncio.create_task(run_order_archiver()))
+    _background_tasks.append(asyncio.create_task(run_dashboard_reconciler()))
+    _background_tasks.append(asyncio.create_task(run_sales_window_refresher()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in _background_tasks:
+        task.cancel()
+    if _related_executor is not None:
+        _related_executor.shutdown(wait=False, cancel_futures=True)
+    await product_counters.flush()
     client.close()
\ No newline at end of file
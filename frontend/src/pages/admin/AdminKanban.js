@@ -6,6 +6,7 @@ import { toast } from 'sonner';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
+const ORDERS_PAGE_SIZE = 500;
 
 const CANCELLATION_REASONS = [
   "Müştəri sifarişdən imtina etdi",
@@ -52,6 +53,9 @@ const STATUS_CONFIG = {
 
 const AdminKanban = () => {
   const [orders, setOrders] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [totalOrders, setTotalOrders] = useState(0);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [loading, setLoading] = useState(true);
   const [draggedOrder, setDraggedOrder] = useState(null);
   const [cancellingOrder, setCancellingOrder] = useState(null);
@@ -62,14 +66,22 @@ const AdminKanban = () => {
     fetchOrders();
   }, []);
 
+  // The endpoint is cursor-paginated: next page cursor and total come in headers
+  const fetchOrderPage = async (cursor) => {
+    const token = localStorage.getItem('admin_token');
+    const { data, headers } = await axios.get(`${API}/orders`, {
+      headers: { Authorization: `Bearer ${token}` },
+      params: cursor ? { limit: ORDERS_PAGE_SIZE, cursor } : { limit: ORDERS_PAGE_SIZE }
+    });
+    setNextCursor(headers['x-next-cursor'] || null);
+    setTotalOrders(Number(headers['x-total-count']) || data.length);
+    return data;
+  };
+
   const fetchOrders = async () => {
     try {
       setLoading(true);
-      const token = localStorage.getItem('admin_token');
-      const { data } = await axios.get(`${API}/orders`, {
-        headers: { Authorization: `Bearer ${token}` }
-      });
-      setOrders(data);
+      setOrders(await fetchOrderPage());
     } catch (error) {
       console.error('Error:', error);
       toast.error('Sifarişlər yüklənə bilmədi');
@@ -78,6 +90,20 @@ const AdminKanban = () => {
     }
   };
 
+  const loadMoreOrders = async () => {
+    if (!nextCursor) return;
+    try {
+      setLoadingMore(true);
+      const data = await fetchOrderPage(nextCursor);
+      setOrders(prev => [...prev, ...data]);
+    } catch (error) {
+      console.error('Error:', error);
+      toast.error('Sifarişlər yüklənə bilmədi');
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const handleDragStart = (e, order) => {
     setDraggedOrder(order);
     e.dataTransfer.effectAllowed = 'move';
@@ -181,8 +207,20 @@ const AdminKanban = () => {
             <div className="flex items-center gap-3">
               <div className="bg-gray-100 px-4 py-2 rounded-lg">
                 <span className="text-sm text-gray-600">Cəmi Sifarişlər: </span>
-                <span className="font-bold text-gray-900">{orders.length}</span>
+                <span className="font-bold text-gray-900">
+                  {nextCursor ? `${orders.length} / ${totalOrders}` : orders.length}
+                </span>
               </div>
+              {nextCursor && (
+                <button
+                  onClick={loadMoreOrders}
+                  disabled={loadingMore}
+                  className="px-4 py-2 rounded-lg text-white font-semibold disabled:opacity-50"
+                  style={{ backgroundColor: '#23B45D' }}
+                >
+                  {loadingMore ? 'Yüklənir...' : 'Daha çox yüklə'}
+                </button>
+              )}
             </div>
           </div>
         </div>
@@ -10,6 +10,8 @@ const API = `${BACKEND_URL}/api`;
 const AdminPayments = () => {
   const navigate = useNavigate();
   const [payments, setPayments] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [loading, setLoading] = useState(true);
   const [stats, setStats] = useState({
     total: 0,
@@ -22,22 +24,38 @@ const AdminPayments = () => {
     fetchPayments();
   }, []);
 
+  // The ledger is cursor-paginated: the next page cursor comes in a header
+  const fetchPaymentPage = async (cursor) => {
+    const token = localStorage.getItem('admin_token');
+    const { data, headers } = await axios.get(`${API}/admin/payments`, {
+      headers: { Authorization: `Bearer ${token}` },
+      params: cursor ? { cursor } : {}
+    });
+    setNextCursor(headers['x-next-cursor'] || null);
+    return data;
+  };
+
+  // Card totals cover the whole ledger, not just the loaded page
+  const fetchStats = async () => {
+    const token = localStorage.getItem('admin_token');
+    const { data } = await axios.get(`${API}/admin/payments/summary`, {
+      headers: { Authorization: `Bearer ${token}` }
+    });
+    const countOf = (...statuses) => data.by_status
+      .filter(row => statuses.includes(row.payment_status))
+      .reduce((sum, row) => sum + row.count, 0);
+    setStats({
+      total: data.count,
+      paid: countOf('paid'),
+      pending: countOf('unpaid', 'pending'),
+      failed: countOf('failed')
+    });
+  };
+
   const fetchPayments = async () => {
     try {
-      const token = localStorage.getItem('admin_token');
-      const { data } = await axios.get(`${API}/admin/payments`, {
-        headers: { Authorization: `Bearer ${token}` }
-      });
-      setPayments(data);
-
-      // Calculate stats
-      const stats = {
-        total: data.length,
-        paid: data.filter(p => p.payment_status === 'paid').length,
-        pending: data.filter(p => p.payment_status === 'unpaid' || p.payment_status === 'pending').length,
-        failed: data.filter(p => p.payment_status === 'failed').length
-      };
-      setStats(stats);
+      const [page] = await Promise.all([fetchPaymentPage(), fetchStats()]);
+      setPayments(page);
     } catch (error) {
       console.error('Error:', error);
       toast.error('Ödənişlər yüklənə bilmədi');
@@ -46,6 +64,20 @@ const AdminPayments = () => {
     }
   };
 
+  const loadMorePayments = async () => {
+    if (!nextCursor) return;
+    try {
+      setLoadingMore(true);
+      const data = await fetchPaymentPage(nextCursor);
+      setPayments(prev => [...prev, ...data]);
+    } catch (error) {
+      console.error('Error:', error);
+      toast.error('Ödənişlər yüklənə bilmədi');
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const handleLogout = () => {
     localStorage.removeItem('admin_token');
     localStorage.removeItem('admin_user');
@@ -229,6 +261,20 @@ const AdminPayments = () => {
             </table>
           </div>
 
+          {nextCursor && (
+            <div className="flex items-center justify-between px-6 py-4 border-t border-[#d4e8df]">
+              <span className="text-sm text-[#5a7869]">{payments.length} / {stats.total}</span>
+              <button
+                onClick={loadMorePayments}
+                disabled={loadingMore}
+                className="px-4 py-2 rounded-lg text-white font-semibold disabled:opacity-50"
+                style={{ backgroundColor: '#23B45D' }}
+              >
+                {loadingMore ? 'Yüklənir...' : 'Daha çox yüklə'}
+              </button>
+            </div>
+          )}
+
           {payments.length === 0 && (
             <div className="text-center py-20">
               <DollarSign className="w-16 h-16 mx-auto mb-4 text-gray-400" />
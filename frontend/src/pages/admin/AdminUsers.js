@@ -9,6 +9,10 @@ const API = `${BACKEND_URL}/api`;
 
 const AdminUsers = () => {
   const [users, setUsers] = useState([]);
+  const [search, setSearch] = useState('');
+  const [nextCursor, setNextCursor] = useState(null);
+  const [totalUsers, setTotalUsers] = useState(0);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [loading, setLoading] = useState(true);
   const [viewingUser, setViewingUser] = useState(null);
   const [editingUser, setEditingUser] = useState(null);
@@ -25,26 +29,38 @@ const AdminUsers = () => {
     profile_picture: ''
   });
 
+  // Search runs server-side; wait for typing to pause before refetching
   useEffect(() => {
-    fetchUsers();
-  }, []);
+    const timer = setTimeout(fetchUsers, search ? 300 : 0);
+    return () => clearTimeout(timer);
+  }, [search]);
 
   // Auto-fetch user details when viewing user modal
   useEffect(() => {
-    if (viewingUser) {
+    if (viewingUser && !viewingUser.detailLoaded) {
       fetchUserDetails(viewingUser.id);
     }
   }, [viewingUser]);
 
+  // The list is cursor-paginated: next page cursor and total come in headers
+  const fetchUserPage = async (cursor) => {
+    const token = localStorage.getItem('admin_token');
+    const params = {};
+    if (search.trim()) params.search = search.trim();
+    if (cursor) params.cursor = cursor;
+    const { data, headers } = await axios.get(`${API}/admin/users`, {
+      headers: { Authorization: `Bearer ${token}` },
+      withCredentials: true,
+      params
+    });
+    setNextCursor(headers['x-next-cursor'] || null);
+    setTotalUsers(Number(headers['x-total-count']) || data.length);
+    return data;
+  };
+
   const fetchUsers = async () => {
     try {
-      setLoading(true);
-      const token = localStorage.getItem('admin_token');
-      const { data } = await axios.get(`${API}/admin/users`, {
-        headers: { Authorization: `Bearer ${token}` },
-        withCredentials: true
-      });
-      setUsers(data);
+      setUsers(await fetchUserPage());
     } catch (error) {
       console.error('Error:', error);
       toast.error('İstifadəçilər yüklənə bilmədi');
@@ -53,33 +69,36 @@ const AdminUsers = () => {
     }
   };
 
+  const loadMoreUsers = async () => {
+    if (!nextCursor) return;
+    try {
+      setLoadingMore(true);
+      const data = await fetchUserPage(nextCursor);
+      setUsers(prev => [...prev, ...data]);
+    } catch (error) {
+      console.error('Error:', error);
+      toast.error('İstifadəçilər yüklənə bilmədi');
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const fetchUserDetails = async (userId) => {
     try {
       const token = localStorage.getItem('admin_token');
       
-      // Fetch user cards
-      try {
-        const { data: cards } = await axios.get(`${API}/admin/users/${userId}/cards`, {
-          headers: { Authorization: `Bearer ${token}` }
-        });
-        setUserCards(prev => ({ ...prev, [userId]: cards }));
-      } catch (error) {
-        console.error('Cards error:', error);
-        setUserCards(prev => ({ ...prev, [userId]: [] }));
-      }
-
-      // Fetch user orders
-      try {
-        const { data: orders } = await axios.get(`${API}/admin/users/${userId}/orders`, {
-          headers: { Authorization: `Bearer ${token}` }
-        });
-        setUserOrders(prev => ({ ...prev, [userId]: orders }));
-      } catch (error) {
-        console.error('Orders error:', error);
-        setUserOrders(prev => ({ ...prev, [userId]: [] }));
-      }
+      // Cards and orders come from one composite call
+      const { data } = await axios.get(`${API}/admin/users/${userId}/detail`, {
+        headers: { Authorization: `Bearer ${token}` }
+      });
+      setUserCards(prev => ({ ...prev, [userId]: data.cards }));
+      setUserOrders(prev => ({ ...prev, [userId]: data.recent_orders }));
+      // The list row is a lean projection; show the full profile (avatar, bonus)
+      setViewingUser(prev => (prev && prev.id === userId ? { ...prev, ...data.user, detailLoaded: true } : prev));
     } catch (error) {
       console.error('Error fetching user details:', error);
+      setUserCards(prev => ({ ...prev, [userId]: [] }));
+      setUserOrders(prev => ({ ...prev, [userId]: [] }));
     }
   };
 
@@ -102,7 +121,20 @@ const AdminUsers = () => {
     }
   };
 
-  const handleEditUser = (user) => {
+  const handleEditUser = async (listUser) => {
+    // Load the full profile so saving never blanks fields the list row omits
+    let user = listUser;
+    try {
+      const token = localStorage.getItem('admin_token');
+      const { data } = await axios.get(`${API}/admin/users/${listUser.id}/detail`, {
+        headers: { Authorization: `Bearer ${token}` }
+      });
+      user = { ...listUser, ...data.user };
+    } catch (error) {
+      console.error('Error:', error);
+      toast.error('İstifadəçi məlumatları yüklənə bilmədi');
+      return;
+    }
     setEditingUser(user);
     setEditForm({
       name: user.name || '',
@@ -269,7 +301,7 @@ const AdminUsers = () => {
             <p className="text-gray-600">Bütün qeydiyyatlı istifadəçilər</p>
           </div>
           <button 
-            onClick={fetchUsers}
+            onClick={() => fetchUsers()}
             className="flex items-center gap-2 px-4 py-2 bg-[#23B45D] text-white rounded-lg hover:opacity-90"
           >
             <RefreshCw className="w-5 h-5" />
@@ -277,6 +309,16 @@ const AdminUsers = () => {
           </button>
         </div>
 
+        <div className="mb-4">
+          <input
+            type="text"
+            value={search}
+            onChange={(e) => setSearch(e.target.value)}
+            placeholder="Ad, email və ya telefon ilə axtar..."
+            className="w-full max-w-md px-4 py-2 border rounded-lg focus:outline-none focus:ring-2 focus:ring-[#23B45D]"
+          />
+        </div>
+
         {/* Users Table */}
         <div className="bg-white rounded-2xl shadow-sm overflow-hidden">
           <table className="w-full">
@@ -358,8 +400,19 @@ const AdminUsers = () => {
           </table>
         </div>
 
-        <div className="mt-4 text-sm text-gray-600">
-          Cəmi: {users.length} istifadəçi
+        <div className="mt-4 flex items-center justify-between text-sm text-gray-600">
+          <span>
+            Göstərilir: {users.length} / {totalUsers} istifadəçi
+          </span>
+          {nextCursor && (
+            <button
+              onClick={loadMoreUsers}
+              disabled={loadingMore}
+              className="px-4 py-2 bg-[#23B45D] text-white rounded-lg hover:opacity-90 disabled:opacity-50"
+            >
+              {loadingMore ? 'Yüklənir...' : 'Daha çox yüklə'}
+            </button>
+          )}
         </div>
       </div>
 
@@ -661,7 +714,7 @@ const AdminUsers = () => {
                           </span>
                         </div>
                         <div className="text-sm text-gray-600">
-                          <p>{order.items?.length || 0} məhsul</p>
+                          <p>{order.item_count ?? order.items?.length ?? 0} məhsul</p>
                           <p className="font-bold text-[#23B45D]">₼{order.total}</p>
                         </div>
                       </div>
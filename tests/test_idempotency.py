@@ -0,0 +1,228 @@
+"""
+Idempotency-Key handling.
+
+Runs run_idempotent against an in-memory mongomock collection: replay of a
+completed response, release of the claim when the handler fails, keeping the
+claim when only storing the response fails, and takeover of abandoned claims.
+"""
+
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from pymongo.errors import PyMongoError
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+server = pytest.importorskip("server")
+
+
+def make_request(key=None, body=b'{"total": 10}'):
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+    headers = [(b"idempotency-key", key.encode())] if key else []
+    return server.Request({"type": "http", "method": "POST", "path": "/", "headers": headers}, receive)
+
+
+class CountingHandler:
+    def __init__(self, fail=False):
+        self.calls = 0
+        self.fail = fail
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(0)
+        if self.fail:
+            raise RuntimeError("handler failed")
+        return {"id": "order-1", "call": self.calls}
+
+
+class FailingUpdates:
+    """Collection whose update_one always raises, as if the write was lost"""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self.update_attempts = 0
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    async def update_one(self, *args, **kwargs):
+        self.update_attempts += 1
+        raise PyMongoError("connection reset")
+
+
+class FailingResponseSaves(FailingUpdates):
+    """Only the write carrying the response body fails"""
+
+    async def update_one(self, filter, update, *args, **kwargs):
+        if "response" in update.get("$set", {}):
+            return await super().update_one(filter, update, *args, **kwargs)
+        return await self._collection.update_one(filter, update, *args, **kwargs)
+
+
+class OtherWorker(dict):
+    """In-flight registry that never shows this worker's futures, as seen from another process"""
+
+    def get(self, key, default=None):
+        return default
+
+
+def backdate(keys, record_id, seconds):
+    past = datetime.now(timezone.utc) - timedelta(seconds=seconds)
+    asyncio.run(keys.update_one({"_id": record_id}, {"$set": {"created_at": past, "heartbeat_at": past}}))
+
+
+@pytest.fixture
+def keys(monkeypatch):
+    db = mongomock_motor.AsyncMongoMockClient()['idempotency_test']
+    monkeypatch.setattr(server, "db", db)
+    return db.idempotency_keys
+
+
+def test_without_key_every_request_runs(keys):
+    handler = CountingHandler()
+    asyncio.run(server.run_idempotent(make_request(), "orders", handler))
+    asyncio.run(server.run_idempotent(make_request(), "orders", handler))
+    assert handler.calls == 2
+
+
+def test_repeated_key_replays_the_stored_response(keys):
+    handler = CountingHandler()
+    first = asyncio.run(server.run_idempotent(make_request("k1"), "orders", handler))
+    replay = asyncio.run(server.run_idempotent(make_request("k1"), "orders", handler))
+
+    assert handler.calls == 1
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert json.loads(replay.body) == first
+
+
+def test_concurrent_duplicates_run_the_handler_once(keys):
+    handler = CountingHandler()
+
+    async def both():
+        return await asyncio.gather(
+            server.run_idempotent(make_request("k2"), "orders", handler),
+            server.run_idempotent(make_request("k2"), "orders", handler)
+        )
+
+    first, replay = asyncio.run(both())
+    assert handler.calls == 1
+    assert json.loads(replay.body) == first
+
+
+def test_key_reused_with_a_different_body_is_rejected(keys):
+    asyncio.run(server.run_idempotent(make_request("k3"), "orders", CountingHandler()))
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(server.run_idempotent(make_request("k3", b'{"total": 99}'), "orders", CountingHandler()))
+    assert exc.value.status_code == 422
+
+
+def test_replay_matches_the_response_model_output(keys):
+    order = {
+        "id": "ATB1", "customer_name": "Leyla", "customer_email": "l@example.com",
+        "customer_phone": "+994501234567", "delivery_address": "Baku", "subtotal": 10, "total": 10,
+        "created_at": "2025-03-01T10:00:00+00:00", "updated_at": "2025-03-01T10:00:00+00:00",
+        "internal_note": "not part of Order"
+    }
+
+    async def handler():
+        return dict(order)
+
+    asyncio.run(server.run_idempotent(make_request("k10"), "orders", handler, response_model=server.Order))
+    replay = asyncio.run(server.run_idempotent(make_request("k10"), "orders", handler, response_model=server.Order))
+
+    assert json.loads(replay.body) == server.Order.model_validate(order).model_dump(mode="json")
+    assert "internal_note" not in json.loads(replay.body)
+
+
+def test_handler_failure_releases_the_claim(keys):
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.run_idempotent(make_request("k4"), "orders", CountingHandler(fail=True)))
+    assert asyncio.run(keys.find_one({"_id": "orders:k4"})) is None
+
+    retry = CountingHandler()
+    assert asyncio.run(server.run_idempotent(make_request("k4"), "orders", retry)) == {"id": "order-1", "call": 1}
+    assert retry.calls == 1
+
+
+def test_failed_response_save_keeps_the_claim(keys, monkeypatch):
+    failing = FailingUpdates(keys)
+    monkeypatch.setattr(server, "db", SimpleNamespace(idempotency_keys=failing))
+    monkeypatch.setattr(server, "IDEMPOTENCY_WAIT_SECONDS", 0)
+    handler = CountingHandler()
+
+    result = asyncio.run(server.run_idempotent(make_request("k5"), "orders", handler))
+    assert result == {"id": "order-1", "call": 1}
+    # every attempt also tries to mark the claim succeeded
+    assert failing.update_attempts == 2 * server.IDEMPOTENCY_SAVE_ATTEMPTS
+    assert asyncio.run(keys.find_one({"_id": "orders:k5"}))['state'] == "in_progress"
+
+    # The side effects happened, so a retry must not run the handler again
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(server.run_idempotent(make_request("k5"), "orders", handler))
+    assert exc.value.status_code == 409
+    assert handler.calls == 1
+
+
+def test_succeeded_claim_is_not_taken_over_after_the_lock_expires(keys, monkeypatch):
+    monkeypatch.setattr(server, "db", SimpleNamespace(idempotency_keys=FailingResponseSaves(keys)))
+    monkeypatch.setattr(server, "IDEMPOTENCY_WAIT_SECONDS", 0)
+    handler = CountingHandler()
+
+    asyncio.run(server.run_idempotent(make_request("k6"), "orders", handler))
+    backdate(keys, "orders:k6", server.IDEMPOTENCY_LOCK_SECONDS + 10)
+
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(server.run_idempotent(make_request("k6"), "orders", handler))
+    assert exc.value.status_code == 409
+    assert handler.calls == 1
+    assert asyncio.run(keys.find_one({"_id": "orders:k6"}))['state'] == "succeeded"
+
+
+def test_claim_of_a_dead_worker_is_taken_over(keys):
+    now = datetime.now(timezone.utc)
+    asyncio.run(keys.insert_one({
+        "_id": "orders:k7",
+        "state": "in_progress",
+        "fingerprint": server.hashlib.sha256(b'{"total": 10}').hexdigest(),
+        "created_at": now,
+        "heartbeat_at": now
+    }))
+    backdate(keys, "orders:k7", server.IDEMPOTENCY_LOCK_SECONDS + 10)
+    handler = CountingHandler()
+
+    assert asyncio.run(server.run_idempotent(make_request("k7"), "orders", handler)) == {"id": "order-1", "call": 1}
+    assert handler.calls == 1
+
+
+def test_slow_handler_keeps_its_claim_past_the_lock_window(keys, monkeypatch):
+    monkeypatch.setattr(server, "IDEMPOTENCY_LOCK_SECONDS", 0.2)
+    monkeypatch.setattr(server, "IDEMPOTENCY_HEARTBEAT_SECONDS", 0.05)
+    monkeypatch.setattr(server, "IDEMPOTENCY_WAIT_SECONDS", 0.1)
+    monkeypatch.setattr(server, "_idempotency_inflight", OtherWorker())
+    calls = []
+
+    async def slow_handler():
+        calls.append(1)
+        await asyncio.sleep(0.6)
+        return {"id": "order-1"}
+
+    async def owner_and_duplicate():
+        owner = asyncio.create_task(server.run_idempotent(make_request("k8"), "orders", slow_handler))
+        await asyncio.sleep(0.25)
+        with pytest.raises(server.HTTPException) as exc:
+            await server.run_idempotent(make_request("k8"), "orders", slow_handler)
+        await owner
+        return exc.value.status_code
+
+    assert asyncio.run(owner_and_duplicate()) == 409
+    assert len(calls) == 1
@@ -0,0 +1,113 @@
+"""
+Product listing index coverage.
+
+Seeds a 100k-product collection in a throwaway database, creates the declared
+product indexes and asserts that no supported filter + sort shape of
+GET /api/products is planned as a COLLSCAN or, when sorted, as an in-memory SORT.
+"""
+
+import os
+import random
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+pymongo = pytest.importorskip("pymongo")
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+server = pytest.importorskip("server")
+
+SEED_PRODUCTS = 100_000
+CATEGORIES = [str(uuid.uuid4()) for _ in range(25)]
+BRANDS = [f"Brand{i}" for i in range(40)]
+
+# Filter combinations the storefront and admin panel send
+QUERY_SHAPES = [
+    {},
+    {"category_id": CATEGORIES[0]},
+    {"brand": BRANDS[0]},
+    {"min_price": 20.0},
+    {"min_price": 20.0, "max_price": 80.0},
+    {"category_id": CATEGORIES[1], "min_price": 20.0, "max_price": 80.0},
+    {"category_id": CATEGORIES[2], "brand": BRANDS[3]},
+    {"brand": BRANDS[1], "max_price": 50.0},
+    {"search": "shoe"},
+]
+
+
+def _stages(plan):
+    """Yield every stage name in an explain plan tree"""
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _stages(value)
+
+
+@pytest.fixture(scope="module")
+def products():
+    client = pymongo.MongoClient(os.environ['MONGO_URL'], serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command('ping')
+    except pymongo.errors.PyMongoError:
+        pytest.skip("MongoDB is not available")
+
+    db = client[f"atabuy_index_test_{uuid.uuid4().hex[:8]}"]
+    rng = random.Random(42)
+    now = datetime.now(timezone.utc)
+    batch = []
+    for i in range(SEED_PRODUCTS):
+        batch.append({
+            "id": str(uuid.uuid4()),
+            "title": f"Product {i} {rng.choice(['shoe', 'shirt', 'bag', 'watch'])}",
+            "description": "Seeded product",
+            "price": round(rng.uniform(1, 500), 2),
+            "category_id": rng.choice(CATEGORIES),
+            "brand": rng.choice(BRANDS),
+            "stock": rng.randint(0, 100),
+            "is_active": rng.random() < 0.9,
+            "rating": round(rng.uniform(0, 5), 1),
+            "review_count": 0,
+            "created_at": (now - timedelta(minutes=i)).isoformat()
+        })
+        if len(batch) == 10_000:
+            db.products.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        db.products.insert_many(batch, ordered=False)
+    db.products.create_indexes(server.INDEXES["products"])
+
+    yield db.products
+
+    client.drop_database(db.name)
+    client.close()
+
+
+@pytest.mark.parametrize("shape", QUERY_SHAPES)
+@pytest.mark.parametrize("sort", [None, *server.PRODUCT_SORTS])
+def test_product_listing_uses_index(products, shape, sort):
+    query = server.build_product_query(**shape)
+    cursor = products.find(query, {"_id": 0})
+    sort_spec = server.get_product_sort(sort)
+    if sort_spec:
+        cursor = cursor.sort(sort_spec)
+
+    plan = cursor.explain()['queryPlanner']
+    stages = set(_stages(plan.get('winningPlan', {})))
+    assert 'COLLSCAN' not in stages, f"{shape} sort={sort} falls back to COLLSCAN: {plan['winningPlan']}"
+    if sort_spec:
+        assert 'SORT' not in stages, f"{shape} sort={sort} sorts in memory: {plan['winningPlan']}"
+
+
+def test_unknown_sort_is_rejected():
+    with pytest.raises(server.HTTPException) as exc:
+        server.get_product_sort("title")
+    assert exc.value.status_code == 400
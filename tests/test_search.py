@@ -0,0 +1,87 @@
+"""
+Typo-tolerant product search.
+
+Exercises edit_distance and TrigramIndex in memory; no database needed.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+server = pytest.importorskip("server")
+
+PRODUCTS = [
+    {"id": "nike", "title": "Nike Air Max", "brand": "Nike", "description": "Running shoe"},
+    {"id": "adidas", "title": "Adidas Samba", "brand": "Adidas", "description": "Classic sneaker"},
+    {"id": "boots", "title": "Qadın ayaqqabı", "brand": "Zara", "description": "Dəri çəkmə"},
+    {"id": "nikon", "title": "Nikon Z50 camera", "brand": "Nikon", "description": "Mirrorless"},
+    {"id": "puma", "title": "Puma Suede", "brand": "Puma", "description": "Suede sneaker"},
+]
+
+
+@pytest.fixture
+def index():
+    index = server.TrigramIndex()
+    for product in PRODUCTS:
+        index.add(product)
+    return index
+
+
+@pytest.mark.parametrize("a, b, expected", [
+    ("nike", "nike", 0),
+    ("nkie", "nike", 1),
+    ("adidsa", "adidas", 1),
+    ("pma", "puma", 1),
+    ("sneakr", "sneaker", 1),
+])
+def test_edit_distance_counts_adjacent_swap_once(a, b, expected):
+    assert server.edit_distance(a, b, 2) == expected
+
+
+def test_edit_distance_stops_past_max_distance():
+    assert server.edit_distance("nike", "adidas", 1) == 2
+    assert server.edit_distance("a", "adidas", 2) == 3
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("nike", "nike"),
+    ("nkie", "nike"),
+    ("adidsa", "adidas"),
+    ("pmua", "puma"),
+    ("ayaqqabi", "boots"),
+    ("AYAQQABI", "boots"),
+    ("nikon", "nikon"),
+])
+def test_search_tolerates_typos(index, query, expected):
+    assert index.search(query)[0] == expected
+
+
+def test_search_matches_prefix_while_typing(index):
+    assert set(index.search("nik")) == {"nike", "nikon"}
+
+
+def test_search_ranks_products_matching_more_terms_first(index):
+    assert index.search("puma sneaker")[0] == "puma"
+
+
+def test_removed_product_is_not_found(index):
+    index.remove("adidas")
+    assert "adidas" not in index.search("adidas")
+    assert len(index) == len(PRODUCTS) - 1
+
+
+def test_filters_apply_before_the_candidate_cut():
+    index = server.TrigramIndex()
+    for i in range(50):
+        index.add({"id": f"a{i}", "title": "Sneaker", "category_id": "adults", "price": 100})
+    index.add({"id": "kid", "title": "Sneakr", "category_id": "kids", "price": 40})
+    index.add({"id": "cheap", "title": "Sneaker", "category_id": "kids", "price": 5})
+
+    assert "kid" not in index.search("sneaker", limit=10)
+    assert index.search("sneaker", limit=10, category_id="kids") == ["cheap", "kid"]
+    assert index.search("sneaker", limit=10, category_id="kids", min_price=10, max_price=50) == ["kid"]
@@ -0,0 +1,122 @@
+"""
+Stock reservation.
+
+Runs reserve_stock against an in-memory mongomock collection: the all-or-nothing
+decrement, the rollback of a partial reservation, and the transactional path
+that must stay a single bulk_write.
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+server = pytest.importorskip("server")
+
+
+class SessionlessCollection:
+    """Drops the session argument mongomock rejects and records each call"""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        def call(*args, session=None, **kwargs):
+            self.calls.append((name, args, session))
+            return method(*args, **kwargs)
+        return call
+
+
+@pytest.fixture
+def products(monkeypatch):
+    db = mongomock_motor.AsyncMongoMockClient()['stock_test']
+    monkeypatch.setattr(server, "db", db)
+    asyncio.run(db.products.insert_many([
+        {"id": "shoe", "title": "Shoe", "stock": 5},
+        {"id": "bag", "title": "Bag", "stock": 1},
+    ]))
+    return db.products
+
+
+def stock(products):
+    docs = asyncio.run(products.find({}, {"_id": 0}).to_list(None))
+    return {doc['id']: (doc['stock'], doc.get('stock_holds', [])) for doc in docs}
+
+
+def test_reserve_decrements_every_item_and_clears_the_hold(products):
+    asyncio.run(server.reserve_stock([
+        {"product_id": "shoe", "quantity": 2},
+        {"product_id": "shoe", "quantity": 1},
+        {"product_id": "bag", "quantity": 1},
+    ]))
+    assert stock(products) == {"shoe": (2, []), "bag": (0, [])}
+
+
+def test_partial_reservation_is_rolled_back(products):
+    with pytest.raises(server.OutOfStockError) as exc:
+        asyncio.run(server.reserve_stock([
+            {"product_id": "shoe", "quantity": 2},
+            {"product_id": "bag", "quantity": 3},
+        ]))
+    assert exc.value.items == [{"product_id": "bag", "title": "Bag", "requested": 3, "available": 1}]
+    assert stock(products) == {"shoe": (5, []), "bag": (1, [])}
+
+
+def test_unknown_product_is_reported_as_unavailable(products):
+    with pytest.raises(server.OutOfStockError) as exc:
+        asyncio.run(server.reserve_stock([
+            {"product_id": "shoe", "quantity": 1},
+            {"product_id": "ghost", "quantity": 1},
+        ]))
+    assert exc.value.items == [{"product_id": "ghost", "title": None, "requested": 1, "available": 0}]
+    assert stock(products) == {"shoe": (5, []), "bag": (1, [])}
+
+
+def test_transaction_reservation_is_one_untagged_bulk_write(products, monkeypatch):
+    recorder = SessionlessCollection(products)
+    monkeypatch.setattr(server, "db", SimpleNamespace(products=recorder))
+    session = object()
+
+    asyncio.run(server.reserve_stock([{"product_id": "shoe", "quantity": 2}], session=session))
+
+    assert [(name, used) for name, _, used in recorder.calls] == [("bulk_write", session)]
+    (ops,) = recorder.calls[0][1]
+    assert all("$push" not in op._doc for op in ops)
+    assert stock(products) == {"shoe": (3, []), "bag": (1, [])}
+
+
+def test_transaction_shortfall_reads_committed_stock_and_leaves_rollback_to_abort(products, monkeypatch):
+    recorder = SessionlessCollection(products)
+    monkeypatch.setattr(server, "db", SimpleNamespace(products=recorder))
+
+    with pytest.raises(server.OutOfStockError) as exc:
+        asyncio.run(server.reserve_stock([
+            {"product_id": "shoe", "quantity": 2},
+            {"product_id": "bag", "quantity": 3},
+        ], session=object()))
+
+    assert [item['product_id'] for item in exc.value.items] == ["bag"]
+    assert [name for name, _, _ in recorder.calls] == ["bulk_write", "find"]
+    assert recorder.calls[1][2] is None
+
+
+@pytest.mark.parametrize("quantity", [0, -5, "x"])
+def test_non_positive_quantity_is_rejected_before_any_write(products, quantity):
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(server.reserve_stock([
+            {"product_id": "shoe", "quantity": 1},
+            {"product_id": "bag", "quantity": quantity},
+        ]))
+    assert exc.value.status_code == 400
+    assert stock(products) == {"shoe": (5, []), "bag": (1, [])}